@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+from prometheus_client import Counter, Gauge
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Admission metrics
+websocket_admissions = Counter(
+    "websocket_admissions_total",
+    "WebSocket connection attempts by admission outcome",
+    ["instance_id", "result"]  # result: admitted, queued or rejected
+)
+websocket_admission_queue = Gauge(
+    "websocket_admission_queue_depth",
+    "Number of WebSocket connections waiting for an admission token",
+    ["instance_id"],
+    multiprocess_mode="livesum"
+)
+
+
+class AdmissionController:
+    """
+    Token bucket with a bounded wait queue in front of ConnectionManager.connect.
+    When an instance dies its clients all reconnect through the ALB at once;
+    this spreads their accepts (and the Redis work each one triggers) out at
+    ADMISSION_RATE per second and turns the excess away with a jittered
+    retry-after hint instead of letting them pile up.
+    """
+
+    def __init__(self, rate: float, burst: int, queue_size: int):
+        self.rate = rate
+        self.burst = burst
+        self.queue_size = queue_size
+        # May go negative: each waiting connection has reserved a future token
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+        self.waiting = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def retry_after(self) -> float:
+        """Jittered hint (seconds) for a rejected client, long enough for the current queue to drain"""
+        drain_time = (self.waiting + 1) / self.rate
+        return round(max(1.0, drain_time) * random.uniform(1.0, 2.0), 1)
+
+    def is_saturated(self, connection_count: int) -> bool:
+        # SO_REUSEPORT spreads connections evenly, so each worker enforces its share of the cap
+        return settings.MAX_CONNECTIONS > 0 and connection_count >= settings.MAX_CONNECTIONS / settings.WORKERS
+
+    async def acquire(self, connection_count: int) -> Optional[float]:
+        """
+        Wait for an admission token.
+        Returns None once the connection may proceed, or a retry-after hint in seconds if it is rejected.
+        """
+        if self.is_saturated(connection_count):
+            websocket_admissions.labels(instance_id=settings.INSTANCE_ID, result="rejected").inc()
+            return self.retry_after()
+
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            websocket_admissions.labels(instance_id=settings.INSTANCE_ID, result="admitted").inc()
+            return None
+
+        if self.waiting >= self.queue_size:
+            websocket_admissions.labels(instance_id=settings.INSTANCE_ID, result="rejected").inc()
+            return self.retry_after()
+
+        # Reserve the next token and wait until it has been generated
+        self.tokens -= 1
+        wait_time = -self.tokens / self.rate
+        self.waiting += 1
+        websocket_admission_queue.labels(instance_id=settings.INSTANCE_ID).set(self.waiting)
+        websocket_admissions.labels(instance_id=settings.INSTANCE_ID, result="queued").inc()
+        try:
+            await asyncio.sleep(wait_time)
+        finally:
+            self.waiting -= 1
+            websocket_admission_queue.labels(instance_id=settings.INSTANCE_ID).set(self.waiting)
+        return None
+
+    def get_stats(self, connection_count: int):
+        return {
+            "connections": connection_count,
+            "max_connections": settings.MAX_CONNECTIONS,
+            "saturated": self.is_saturated(connection_count),
+            "admission_queue": self.waiting
+        }
+
+
+# Create a global admission controller instance
+# The limits are per instance; with several workers each one admits its share
+admission = AdmissionController(
+    settings.ADMISSION_RATE / settings.WORKERS,
+    max(1, settings.ADMISSION_BURST // settings.WORKERS),
+    max(1, settings.ADMISSION_QUEUE_SIZE // settings.WORKERS)
+)
@@ -1,78 +1,546 @@
 import asyncio
-import random
+import time
 import uuid
 import logging
-from typing import Dict, Any, Tuple
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Tuple
 from datetime import datetime
-from prometheus_client import Histogram
+from prometheus_client import Counter, Gauge, Histogram
 from config import settings
+from envelope import dumps, loads
+from redis_service import redis_service
+from task_handlers import handlers, run_handler, shutdown_pools
 
 logger = logging.getLogger(__name__)
 
-# Track task execution time
+# Track task execution time, and how long tasks waited in the queue before that
 task_execution_time = Histogram(
     "background_task_execution_seconds",
     "Time spent executing background tasks",
-    ["instance_id"]
+    ["instance_id", "priority"]
 )
+task_queue_wait = Histogram(
+    "background_task_queue_wait_seconds",
+    "Time background tasks spent queued before a worker started them",
+    ["instance_id", "priority"],
+    buckets=(0.01, 0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+)
+task_outcomes = Counter(
+    "background_tasks_total",
+    "Number of background tasks by what happened to them on this instance",
+    ["instance_id", "result"]  # result: queued, rejected, completed, failed, requeued or stolen
+)
+task_queue_depth = Gauge(
+    "background_task_queue_depth",
+    "Number of background tasks waiting in the cluster-wide queue",
+    ["instance_id"],
+    multiprocess_mode="livemax"
+)
+
+# Cluster-wide queue of waiting task ids, scored by virtual finish time (see ENQUEUE_SCRIPT)
+TASK_QUEUE_KEY = "tasks:queue"
+# Virtual time of the queue: the finish time of the task most recently started
+TASK_VTIME_KEY = "tasks:vtime"
+# Nodes that have run tasks, checked for dead members by the others
+TASK_NODES_KEY = "tasks:nodes"
+# Prefix of the hash holding one task's record
+TASK_KEY_PREFIX = "task:"
+# Prefix of a client's sets of queued and running task ids
+TASK_CLIENT_PREFIX = "tasks:client:"
+# Task record fields stored as JSON
+JSON_FIELDS = ("params", "result")
+
+# Queue a task unless the queue, or the client's share of it, is full.
+# Weighted fair queuing: every client is a flow, and a task's virtual finish time
+# follows on from the client's previous task (or from the queue's virtual time, if
+# the client has fallen behind it) by 1 / the weight of the task's priority class.
+# Serving tasks in finish-time order interleaves clients, gives higher classes a
+# proportionally larger share, and never starves the lower ones.
+ENQUEUE_SCRIPT = """
+if tonumber(ARGV[1]) > 0 and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+if tonumber(ARGV[2]) > 0 and redis.call('SCARD', KEYS[3]) >= tonumber(ARGV[2]) then
+    return -1
+end
+local now = tonumber(redis.call('GET', KEYS[5]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[4]) or '0')
+local finish = math.max(now, previous) + tonumber(ARGV[4])
+redis.call('SET', KEYS[4], finish, 'EX', ARGV[5])
+for i = 6, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('ZADD', KEYS[1], finish, ARGV[3])
+redis.call('SADD', KEYS[3], ARGV[3])
+redis.call('EXPIRE', KEYS[3], ARGV[5])
+return 1
+"""
+
+# Take the waiting task with the earliest finish time whose client is below its running
+# limit, looking at most ARGV[6] tasks deep, and record it in this node's running set
+# (id -> finish time, so it can be queued again in its old place). Ids whose record
+# has gone are dropped.
+CLAIM_SCRIPT = """
+local candidates = redis.call('ZRANGE', KEYS[1], 0, tonumber(ARGV[6]) - 1, 'WITHSCORES')
+for i = 1, #candidates, 2 do
+    local task_id, finish = candidates[i], candidates[i + 1]
+    local task_key = ARGV[3] .. task_id
+    local client_id = redis.call('HGET', task_key, 'client_id')
+    if not client_id then
+        redis.call('ZREM', KEYS[1], task_id)
+    else
+        local running = ARGV[7] .. client_id .. ':running'
+        if tonumber(ARGV[5]) <= 0 or redis.call('SCARD', running) < tonumber(ARGV[5]) then
+            redis.call('ZREM', KEYS[1], task_id)
+            redis.call('SREM', ARGV[7] .. client_id .. ':queued', task_id)
+            redis.call('SADD', running, task_id)
+            redis.call('EXPIRE', running, ARGV[8])
+            redis.call('HSET', KEYS[2], task_id, finish)
+            if tonumber(finish) > tonumber(redis.call('GET', KEYS[3]) or '0') then
+                redis.call('SET', KEYS[3], finish)
+            end
+            redis.call('HSET', task_key, 'status', 'running', 'node', ARGV[1],
+                'instance_id', ARGV[2], 'started_at', ARGV[4])
+            return task_id
+        end
+    end
+end
+return false
+"""
+
+# Record a task's outcome, unless it was taken back from this node in the meantime
+FINISH_SCRIPT = """
+if redis.call('HDEL', KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call('SREM', KEYS[3], ARGV[1])
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+# Put a node's running tasks back in the queue, if the node is dead (or ARGV[2] is "1")
+REQUEUE_SCRIPT = """
+if ARGV[2] ~= '1' and redis.call('EXISTS', KEYS[3]) == 1 then
+    return -1
+end
+local running = redis.call('HGETALL', KEYS[1])
+for i = 1, #running, 2 do
+    local task_key = ARGV[1] .. running[i]
+    local client_id = redis.call('HGET', task_key, 'client_id')
+    if client_id then
+        redis.call('HSET', task_key, 'status', 'queued')
+        redis.call('HDEL', task_key, 'node', 'started_at')
+        redis.call('ZADD', KEYS[2], running[i + 1], running[i])
+        redis.call('SREM', ARGV[3] .. client_id .. ':running', running[i])
+        redis.call('SADD', ARGV[3] .. client_id .. ':queued', running[i])
+    end
+end
+redis.call('DEL', KEYS[1])
+return #running / 2
+"""
+
+
+class TaskRejected(Exception):
+    """Raised by TaskManager.create_task when the queue is full or Redis can't be reached"""
+
+
+class TaskQuotaExceeded(TaskRejected):
+    """Raised by TaskManager.create_task when the client already has its share of the queue"""
+
+
+def task_key(task_id: str) -> str:
+    return f"{TASK_KEY_PREFIX}{task_id}"
+
+def running_key(node_id: str) -> str:
+    """Hash of the tasks a node is running"""
+    return f"tasks:running:{node_id}"
+
+def client_key(client_id: str, state: str) -> str:
+    """Set of a client's task ids that are queued or running (state)"""
+    return f"{TASK_CLIENT_PREFIX}{client_id}:{state}"
+
+def flow_key(client_id: str) -> str:
+    """Virtual finish time of a client's most recently queued task"""
+    return f"tasks:flow:{client_id}"
+
+def node_key(node_id: str) -> str:
+    """A node's liveness key; it expires TASK_NODE_TTL seconds after the node stops refreshing it"""
+    return f"tasks:node:{node_id}"
+
+def encode_task(task: Dict[str, Any]) -> List[Any]:
+    """A task record (or part of one) as a flat field/value list for HSET; structured fields become JSON"""
+    fields = []
+    for field, value in task.items():
+        fields.append(field)
+        fields.append(dumps(value) if field in JSON_FIELDS else value)
+    return fields
+
+def decode_task(record: Dict[str, str]) -> Dict[str, Any]:
+    """A task record as read from Redis, with its structured fields parsed"""
+    task = dict(record)
+    for field in JSON_FIELDS:
+        if field in task:
+            task[field] = loads(task[field])
+    return task
+
+
+class ProgressReporter:
+    """
+    Forwards a running task's progress updates to its client, at most
+    TASK_PROGRESS_MAX_HZ times per second. Between sends, updates are merged:
+    only the latest progress is kept and partial results are collected, so
+    slow clients get fewer, larger updates rather than a backlog.
+    """
+
+    def __init__(self, task_id: str, client_id: str, send: Callable[[str, str, Dict[str, Any]], Awaitable[None]]):
+        self.task_id = task_id
+        self.client_id = client_id
+        self.send = send
+        self.interval = 1 / settings.TASK_PROGRESS_MAX_HZ
+        self.progress = None
+        self.partials: List[Any] = []
+        # Whether there is an update that hasn't been sent yet
+        self.pending = False
+        self.changed = asyncio.Event()
+        self.closing = asyncio.Event()
+        self.sender = asyncio.create_task(self._send_loop())
+
+    def update(self, update: Dict[str, Any]):
+        """Record an update from the handler; called on the event loop, never blocks"""
+        if "progress" in update:
+            self.progress = update["progress"]
+            self.pending = True
+            self.changed.set()
+        if "partial" in update:
+            self.partials.append(update["partial"])
+            self.pending = True
+            self.changed.set()
+
+    async def _send_loop(self):
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            if self.pending:
+                await self._flush()
+            if self.closing.is_set():
+                return
+            # Rate limit, but don't hold the last update back once the task is done
+            try:
+                await asyncio.wait_for(self.closing.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _flush(self):
+        update = {"progress": self.progress, "partials": self.partials}
+        self.partials = []
+        self.pending = False
+        try:
+            await self.send(self.task_id, self.client_id, update)
+        except Exception as e:
+            logger.error(f"Failed to send progress of task {self.task_id}: {str(e)}")
+
+    async def close(self):
+        """Send the update still pending, if any; call before reporting the task's completion"""
+        self.closing.set()
+        self.changed.set()
+        await self.sender
+
+    def cancel(self):
+        self.sender.cancel()
+
 
 class TaskManager:
+    """
+    Background tasks in a Redis queue shared by every instance.
+
+    create_task only queues the task. Each process runs TASK_WORKERS workers
+    that claim tasks from the queue, so tasks go to whichever node has a free
+    worker, not to the node that received the request. While a node runs a
+    task the task id is in the node's running set; a node that stops
+    refreshing its heartbeat key (crashed or drained) has its running tasks
+    queued again by the surviving nodes. A node shutting down cleanly
+    requeues its own running tasks. Finished records expire after
+    TASK_RESULT_TTL seconds.
+
+    The queue is ordered by weighted fair queuing across clients rather than
+    arrival, so one client queuing many tasks can't hold everyone else back,
+    and each task's priority class sets its weight. A client may have at most
+    TASK_CLIENT_MAX_QUEUED tasks waiting and TASK_CLIENT_MAX_RUNNING running;
+    workers pass over tasks of clients at their running limit.
+    """
+
     def __init__(self):
-        self.tasks = {}
         self.active_task_count = 0
+        self.workers: List[asyncio.Task] = []
+        self.heartbeat_task = None
+        self.wakeup = asyncio.Event()
+        # Set once the tasks of this node's previous incarnation are back in the queue
+        self.ready = asyncio.Event()
+        self.on_complete = None
+        self.on_progress = None
+        self.node_id = settings.WORKER_ID
+        self.enqueue_script = None
+        self.claim_script = None
+        self.finish_script = None
+        self.requeue_script = None
 
-    async def create_task(self, client_id: str) -> Tuple[str, Dict[str, Any]]:
-        task_id = f"task-{uuid.uuid4().hex[:8]}"
-        duration = random.randint(settings.MIN_TASK_DELAY, settings.MAX_TASK_DELAY)
+    @property
+    def redis(self):
+        return redis_service.redis
+
+    async def start(
+        self,
+        on_complete: Callable[[str, Dict[str, Any]], Awaitable[None]],
+        on_progress: Callable[[str, str, Dict[str, Any]], Awaitable[None]]
+    ):
+        """
+        Start the worker pool and the node heartbeat. on_complete(task_id, task) is awaited
+        after each task this node finishes, and on_progress(task_id, client_id, update) with
+        the (coalesced) progress of running tasks. Call after Redis is initialized.
+        """
+        self.on_complete = on_complete
+        self.on_progress = on_progress
+        self.enqueue_script = self.redis.register_script(ENQUEUE_SCRIPT)
+        self.claim_script = self.redis.register_script(CLAIM_SCRIPT)
+        self.finish_script = self.redis.register_script(FINISH_SCRIPT)
+        self.requeue_script = self.redis.register_script(REQUEUE_SCRIPT)
         
-        self.tasks[task_id] = {
+        # The heartbeat requeues this node's orphaned tasks, retrying until Redis answers;
+        # workers wait for that so Redis being down at boot doesn't leave the node without them
+        self.ready.clear()
+        self.heartbeat_task = asyncio.create_task(self._heartbeat())
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(settings.TASK_WORKERS)]
+        logger.info(f"Task manager started with {settings.TASK_WORKERS} workers")
+
+    async def stop(self):
+        """Stop claiming tasks and put the ones still running back in the queue for other nodes"""
+        tasks = self.workers + ([self.heartbeat_task] if self.heartbeat_task else [])
+        if not tasks:
+            return
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        self.heartbeat_task = None
+        shutdown_pools()
+
+        try:
+            await self.requeue_own()
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.delete(node_key(self.node_id))
+            pipeline.srem(TASK_NODES_KEY, self.node_id)
+            await pipeline.execute()
+        except Exception as e:
+            logger.error(f"Failed to requeue unfinished tasks: {str(e)}")
+
+    async def requeue_own(self):
+        """Put every task this node is running back in the queue"""
+        requeued = await self.requeue_script(
+            keys=[running_key(self.node_id), TASK_QUEUE_KEY, node_key(self.node_id)],
+            args=[TASK_KEY_PREFIX, "1", TASK_CLIENT_PREFIX]
+        )
+        if requeued:
+            task_outcomes.labels(instance_id=settings.INSTANCE_ID, result="requeued").inc(requeued)
+            logger.info(f"Requeued {requeued} unfinished tasks")
+
+    async def create_task(
+        self,
+        client_id: str,
+        handler: str = "sleep",
+        params: Optional[Dict[str, Any]] = None,
+        priority: str = settings.TASK_DEFAULT_PRIORITY
+    ) -> Tuple[str, Dict[str, Any]]:
+        """
+        Queue a task for a client, to be run by the named handler (see task_handlers.py)
+        and scheduled by its priority class. Raises ValueError for an unknown handler or
+        priority, TaskQuotaExceeded if the client has too many tasks waiting and
+        TaskRejected if the task can't be queued otherwise.
+        """
+        if handler not in handlers:
+            raise ValueError(f"Unknown task handler {handler}")
+        if priority not in settings.TASK_PRIORITY_WEIGHTS:
+            raise ValueError(f"Unknown task priority {priority}, expected one of {list(settings.TASK_PRIORITY_WEIGHTS)}")
+        task_id = f"task-{uuid.uuid4().hex[:8]}"
+
+        task = {
+            "task_id": task_id,
             "client_id": client_id,
-            "status": "running",
-            "duration": duration,
-            "started_at": datetime.utcnow().isoformat(),
+            "status": "queued",
+            "handler": handler,
+            "params": handlers[handler].params(params),
+            "priority": priority,
+            "created_at": datetime.utcnow().isoformat(),
+            "enqueued_at": time.time(),
             "instance_id": settings.INSTANCE_ID
         }
+        fields = encode_task(task)
+        try:
+            queued = await self.enqueue_script(
+                keys=[TASK_QUEUE_KEY, task_key(task_id), client_key(client_id, "queued"), flow_key(client_id), TASK_VTIME_KEY],
+                args=[
+                    settings.TASK_QUEUE_MAX, settings.TASK_CLIENT_MAX_QUEUED, task_id,
+                    1 / settings.TASK_PRIORITY_WEIGHTS[priority], settings.TASK_RESULT_TTL, *fields
+                ]
+            )
+        except Exception as e:
+            logger.error(f"Failed to queue task {task_id}: {str(e)}")
+            queued = None
+        if queued != 1:
+            task_outcomes.labels(instance_id=settings.INSTANCE_ID, result="rejected").inc()
+            if queued is None:
+                raise TaskRejected("Task queue unavailable")
+            if queued < 0:
+                raise TaskQuotaExceeded(f"Too many queued tasks ({settings.TASK_CLIENT_MAX_QUEUED} waiting for this client)")
+            raise TaskRejected(f"Task queue is full ({settings.TASK_QUEUE_MAX} tasks waiting)")
+
+        task_outcomes.labels(instance_id=settings.INSTANCE_ID, result="queued").inc()
+        logger.info(f"Task {task_id} ({handler}, {priority}) queued for client {client_id}, params: {task['params']}")
+
+        # Our own idle workers needn't wait for their next poll
+        self.wakeup.set()
+        return task_id, task
+
+    async def get_task(self, task_id: str) -> Optional[Dict[str, Any]]:
+        """A task's record, or None if it never existed or has expired"""
+        record = await self.redis.hgetall(task_key(task_id))
+        return decode_task(record) if record else None
+
+    async def _worker(self):
+        await self.ready.wait()
+        while True:
+            try:
+                task_id = await self.claim_script(
+                    keys=[TASK_QUEUE_KEY, running_key(self.node_id), TASK_VTIME_KEY],
+                    args=[
+                        self.node_id, settings.INSTANCE_ID, TASK_KEY_PREFIX, datetime.utcnow().isoformat(),
+                        settings.TASK_CLIENT_MAX_RUNNING, settings.TASK_CLAIM_SCAN, TASK_CLIENT_PREFIX,
+                        settings.TASK_RESULT_TTL
+                    ]
+                )
+            except Exception as e:
+                logger.error(f"Failed to claim a task: {str(e)}")
+                task_id = None
+
+            if task_id is None:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), settings.TASK_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._execute(task_id)
+
+    async def _execute(self, task_id: str):
+        """Run a claimed task and record its outcome"""
         self.active_task_count += 1
-        
-        logger.info(f"Task {task_id} created for client {client_id}, duration: {duration}s")
-        
-        # Return the task immediately but process it in the background
-        return task_id, self.tasks[task_id]
-        
-    async def run_task(self, task_id: str) -> Tuple[str, Dict[str, Any]]:
         try:
-            task = self.tasks.get(task_id)
-            if not task:
-                logger.error(f"Task {task_id} not found")
-                return task_id, {"error": "Task not found"}
-                
-            # Simulate work with a timer
-            with task_execution_time.labels(instance_id=settings.INSTANCE_ID).time():
-                logger.info(f"Task {task_id} running for {task['duration']}s")
-                await asyncio.sleep(task['duration'])
-            
-            # Update task status
-            self.tasks[task_id]["status"] = "completed"
-            self.tasks[task_id]["completed_at"] = datetime.utcnow().isoformat()
-            self.active_task_count -= 1
-            
-            logger.info(f"Task {task_id} completed")
-            return task_id, self.tasks[task_id]
-            
+            task = decode_task(await self.redis.hgetall(task_key(task_id)))
+            priority = task.get("priority", settings.TASK_DEFAULT_PRIORITY)
+            if "enqueued_at" in task:
+                task_queue_wait.labels(instance_id=settings.INSTANCE_ID, priority=priority).observe(
+                    max(0.0, time.time() - float(task["enqueued_at"]))
+                )
+            reporter = ProgressReporter(task_id, task["client_id"], self._report_progress)
+            try:
+                outcome = {"status": "completed", "result": await self.run_task(task_id, task, reporter.update)}
+            except asyncio.CancelledError:
+                # Shutting down; stop() puts the task back in the queue
+                reporter.cancel()
+                raise
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                logger.error(f"Error in task {task_id}: {error}")
+                outcome = {"status": "failed", "error": error}
+            # The last progress update goes out before the completion
+            await reporter.close()
+            outcome["completed_at"] = datetime.utcnow().isoformat()
+
+            fields = encode_task(outcome)
+            finished = await self.finish_script(
+                keys=[running_key(self.node_id), task_key(task_id), client_key(task["client_id"], "running")],
+                args=[task_id, settings.TASK_RESULT_TTL, *fields]
+            )
+            # The client may have tasks that were held back by its running limit
+            self.wakeup.set()
+            if not finished:
+                # Presumed dead and taken back while we were running it; another node owns it now
+                task_outcomes.labels(instance_id=settings.INSTANCE_ID, result="stolen").inc()
+                logger.warning(f"Task {task_id} was requeued while running here, dropping its result")
+                return
+
+            task.update(outcome)
+            task_outcomes.labels(instance_id=settings.INSTANCE_ID, result=outcome["status"]).inc()
+            logger.info(f"Task {task_id} {outcome['status']}")
+            if self.on_complete is not None:
+                await self.on_complete(task_id, task)
+        except asyncio.CancelledError:
+            raise
         except Exception as e:
-            logger.error(f"Error in task {task_id}: {str(e)}")
-            if task_id in self.tasks:
-                self.tasks[task_id]["status"] = "failed"
-                self.tasks[task_id]["error"] = str(e)
-                self.active_task_count -= 1
-            return task_id, self.tasks.get(task_id, {"error": str(e)})
+            logger.error(f"Failed to finish task {task_id}: {str(e)}")
+        finally:
+            self.active_task_count -= 1
+
+    async def run_task(self, task_id: str, task: Dict[str, Any], report: Callable[[Dict[str, Any]], None]) -> Any:
+        """Run a task's handler in its lane (event loop, thread pool or process pool) and return its result"""
+        priority = task.get("priority", settings.TASK_DEFAULT_PRIORITY)
+        with task_execution_time.labels(instance_id=settings.INSTANCE_ID, priority=priority).time():
+            logger.info(f"Task {task_id} running {task['handler']} with {task['params']}")
+            return await run_handler(task["handler"], task["params"], report)
+
+    async def _report_progress(self, task_id: str, client_id: str, update: Dict[str, Any]):
+        # Keep the latest progress in the record too, for GET /tasks/{task_id}
+        if update["progress"] is not None:
+            await self.redis.hset(task_key(task_id), "progress", update["progress"])
+        if self.on_progress is not None:
+            await self.on_progress(task_id, client_id, update)
+
+    async def _heartbeat(self):
+        """Keep this node's liveness key fresh and take back the tasks of nodes that died"""
+        while True:
+            try:
+                if not self.ready.is_set():
+                    # A restarted worker reuses its node id; tasks its previous incarnation was running are orphaned
+                    await self.requeue_own()
+                    self.ready.set()
+                pipeline = self.redis.pipeline(transaction=False)
+                pipeline.set(node_key(self.node_id), settings.INSTANCE_ID, ex=settings.TASK_NODE_TTL)
+                pipeline.sadd(TASK_NODES_KEY, self.node_id)
+                pipeline.smembers(TASK_NODES_KEY)
+                pipeline.zcard(TASK_QUEUE_KEY)
+                _, _, nodes, depth = await pipeline.execute()
+                task_queue_depth.labels(instance_id=settings.INSTANCE_ID).set(depth)
+
+                for node_id in nodes:
+                    if node_id != self.node_id:
+                        await self.requeue_if_dead(node_id)
+            except Exception as e:
+                logger.error(f"Task heartbeat failed: {str(e)}")
+
+            await asyncio.sleep(settings.TASK_HEARTBEAT_INTERVAL)
+
+    async def requeue_if_dead(self, node_id: str):
+        """Queue the running tasks of a node again if its liveness key has expired"""
+        requeued = await self.requeue_script(
+            keys=[running_key(node_id), TASK_QUEUE_KEY, node_key(node_id)],
+            args=[TASK_KEY_PREFIX, "0", TASK_CLIENT_PREFIX]
+        )
+        if requeued < 0:
+            return
+        await self.redis.srem(TASK_NODES_KEY, node_id)
+        if requeued:
+            task_outcomes.labels(instance_id=settings.INSTANCE_ID, result="requeued").inc(requeued)
+            logger.warning(f"Node {node_id} is gone, requeued its {requeued} running tasks")
+            self.wakeup.set()
 
     def get_task_stats(self):
         return {
             "instance_id": settings.INSTANCE_ID,
             "active_tasks": self.active_task_count,
-            "total_tasks": len(self.tasks)
+            "workers": len(self.workers)
         }
 
 # Create a global task manager instance
-task_manager = TaskManager()
\ No newline at end of file
+task_manager = TaskManager()
@@ -6,6 +6,21 @@ class Settings:
     # Generate a persistent instance ID (simulating different EC2 instances)
     INSTANCE_ID = os.getenv("INSTANCE_ID", f"{socket.gethostname()}-{uuid.uuid4().hex[:8]}")
     
+    # Multi-process mode: WORKERS processes share the listening port (SO_REUSEPORT) under one
+    # INSTANCE_ID. Each worker gets its own WORKER_ID; with a single worker it equals INSTANCE_ID.
+    WORKERS = int(os.getenv("WORKERS", "1"))
+    WORKER_INDEX = int(os.getenv("WORKER_INDEX", "0"))
+    WORKER_ID = INSTANCE_ID if WORKERS == 1 else f"{INSTANCE_ID}-w{WORKER_INDEX}"
+    # Directory holding the Unix sockets workers use to fan messages out to each other
+    WORKER_SOCKET_DIR = os.getenv("WORKER_SOCKET_DIR", "/tmp/ws-workers")
+    WORKER_STATS_INTERVAL = float(os.getenv("WORKER_STATS_INTERVAL", "2"))
+    # Largest frame sent over the worker sockets; bigger ones go through Redis instead
+    WORKER_BUS_MAX_FRAME = int(os.getenv("WORKER_BUS_MAX_FRAME", "65536"))
+    
+    # Server settings
+    HOST = os.getenv("HOST", "0.0.0.0")
+    PORT = int(os.getenv("PORT", "8000"))
+    
     # Application settings
     APP_NAME = "FastAPI WebSocket Scaling Demo"
     DEBUG = os.getenv("DEBUG", "False").lower() == "true"
@@ -20,6 +35,50 @@ class Settings:
     MAX_TASK_DELAY = 15
     MIN_TASK_DELAY = 5
     
+    # Background tasks are queued in Redis and run by TASK_WORKERS concurrent workers per
+    # process on whichever node claims them first. At most TASK_QUEUE_MAX tasks may wait.
+    # Finished task records are kept for TASK_RESULT_TTL seconds. Idle workers check the
+    # queue every TASK_POLL_INTERVAL seconds. A node that has not refreshed its heartbeat
+    # for TASK_NODE_TTL seconds is presumed dead and its running tasks are queued again.
+    TASK_WORKERS = int(os.getenv("TASK_WORKERS", "4"))
+    TASK_QUEUE_MAX = int(os.getenv("TASK_QUEUE_MAX", "10000"))
+    TASK_RESULT_TTL = int(os.getenv("TASK_RESULT_TTL", "3600"))
+    TASK_POLL_INTERVAL = float(os.getenv("TASK_POLL_INTERVAL", "1"))
+    TASK_HEARTBEAT_INTERVAL = float(os.getenv("TASK_HEARTBEAT_INTERVAL", "10"))
+    TASK_NODE_TTL = int(os.getenv("TASK_NODE_TTL", "30"))
+    
+    # Task scheduling: tasks are served by weighted fair queuing across clients, each task
+    # weighted by its priority class (TASK_PRIORITY_WEIGHTS, "class:weight,..."). A client may
+    # have at most TASK_CLIENT_MAX_QUEUED tasks waiting and TASK_CLIENT_MAX_RUNNING running
+    # (0 = no limit); workers look at most TASK_CLAIM_SCAN tasks deep for one they may start.
+    TASK_PRIORITY_WEIGHTS = {
+        name: float(weight)
+        for name, weight in (item.split(":") for item in os.getenv("TASK_PRIORITY_WEIGHTS", "high:4,normal:2,low:1").split(","))
+    }
+    TASK_DEFAULT_PRIORITY = os.getenv("TASK_DEFAULT_PRIORITY", "normal")
+    TASK_CLIENT_MAX_QUEUED = int(os.getenv("TASK_CLIENT_MAX_QUEUED", "20"))
+    TASK_CLIENT_MAX_RUNNING = int(os.getenv("TASK_CLIENT_MAX_RUNNING", "2"))
+    TASK_CLAIM_SCAN = int(os.getenv("TASK_CLAIM_SCAN", "50"))
+    
+    # Executors for task handlers declared "thread" or "process" (see task_handlers.py), per process.
+    # HASH_CHAIN_ROUNDS and PRIMES_LIMIT are the default sizes of the CPU-bound demo tasks and the
+    # *_MAX settings the largest a client may ask for; sleeping tasks are capped at MAX_TASK_DELAY.
+    TASK_THREAD_WORKERS = int(os.getenv("TASK_THREAD_WORKERS", "4"))
+    TASK_PROCESS_WORKERS = int(os.getenv("TASK_PROCESS_WORKERS", "2"))
+    HASH_CHAIN_ROUNDS = int(os.getenv("HASH_CHAIN_ROUNDS", "2000000"))
+    PRIMES_LIMIT = int(os.getenv("PRIMES_LIMIT", "200000"))
+    HASH_CHAIN_MAX_ROUNDS = int(os.getenv("HASH_CHAIN_MAX_ROUNDS", "20000000"))
+    PRIMES_MAX_LIMIT = int(os.getenv("PRIMES_MAX_LIMIT", "2000000"))
+    
+    # Progress updates of a running task are sent to its client at most this many times per second
+    TASK_PROGRESS_MAX_HZ = float(os.getenv("TASK_PROGRESS_MAX_HZ", "4"))
+    
+    # Event-loop lag is sampled every LOOP_LAG_INTERVAL seconds; the worst lag of each
+    # LOOP_LAG_REPORT_INTERVAL is exported, and logged when it reaches LOOP_LAG_WARNING
+    LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+    LOOP_LAG_REPORT_INTERVAL = float(os.getenv("LOOP_LAG_REPORT_INTERVAL", "10"))
+    LOOP_LAG_WARNING = float(os.getenv("LOOP_LAG_WARNING", "0.1"))
+    
     # Redis configuration - supports both local and AWS ElastiCache
     REDIS_HOST = os.getenv("REDIS_HOST", "redis")
     REDIS_PORT = int(os.getenv("REDIS_PORT", "6379"))
@@ -32,12 +91,94 @@ class Settings:
     else:
         REDIS_URL = os.getenv("REDIS_URL", f"redis://{REDIS_HOST}:{REDIS_PORT}/{REDIS_DB}")
     
+    # Shared connection pool used by RedisService and the message bus. Callers wait for a free
+    # connection once all are in use; the pub/sub listener holds one for good.
+    REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+    # Must stay above STREAM_BLOCK_MS so blocking stream reads don't time out
+    REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", "5"))
+    REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv("REDIS_SOCKET_CONNECT_TIMEOUT", "5"))
+    REDIS_SOCKET_KEEPALIVE = os.getenv("REDIS_SOCKET_KEEPALIVE", "True").lower() == "true"
+    REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", "30"))
+    
     # AWS specific settings
     AWS_REGION = os.getenv("AWS_REGION", "ap-southeast-1")
     ENVIRONMENT = os.getenv("ENVIRONMENT", "development")
     
+    # Cross-instance transport: "pubsub" (fire-and-forget) or "streams" (Redis Streams with replay)
+    BUS_TRANSPORT = os.getenv("BUS_TRANSPORT", "pubsub")
+    STREAM_MAXLEN = int(os.getenv("STREAM_MAXLEN", "10000"))
+    STREAM_READ_COUNT = int(os.getenv("STREAM_READ_COUNT", "100"))
+    STREAM_BLOCK_MS = int(os.getenv("STREAM_BLOCK_MS", "1000"))
+    STREAM_OFFSET_TTL = 86400
+    # Max messages sent to a client resuming from a stream id
+    STREAM_RESUME_LIMIT = 500
+    
+    # Message bus listener supervision: reconnect backoff bounds (seconds), and how long
+    # the bus may stay disconnected before /health reports the instance as unhealthy
+    BUS_RECONNECT_MIN_DELAY = float(os.getenv("BUS_RECONNECT_MIN_DELAY", "0.5"))
+    BUS_RECONNECT_MAX_DELAY = float(os.getenv("BUS_RECONNECT_MAX_DELAY", "30"))
+    BUS_UNHEALTHY_AFTER = float(os.getenv("BUS_UNHEALTHY_AFTER", "10"))
+    
+    # Cluster-wide registry of which node (worker) holds each client's connection, used to
+    # route direct messages to a single node. The heartbeat refreshes the entries of live
+    # connections about every HEARTBEAT_INTERVAL; entries of nodes that die expire after this long.
+    CONNECTION_REGISTRY_TTL = int(os.getenv("CONNECTION_REGISTRY_TTL", "300"))
+    
+    # Chat rooms; every connection joins DEFAULT_ROOM when it connects
+    DEFAULT_ROOM = "global"
+    
     # Message storage settings
     MESSAGE_RETENTION_DAYS = 7
     MAX_MESSAGES_PER_USER = 1000
+    MAX_MESSAGES_PER_ROOM = 10000
+    
+    # Message write coalescing: wait at most this long for more writes before flushing,
+    # and never put more than MESSAGE_FLUSH_MAX_BATCH messages in one pipeline
+    MESSAGE_FLUSH_INTERVAL_MS = int(os.getenv("MESSAGE_FLUSH_INTERVAL_MS", "5"))
+    MESSAGE_FLUSH_MAX_BATCH = int(os.getenv("MESSAGE_FLUSH_MAX_BATCH", "500"))
+    
+    # In-memory cache of the newest default-room messages, used for connect-time history.
+    # HISTORY_CACHE_MODE: "local" serves reads from the cache while it is live, "redis" always reads Redis.
+    # The cache is reloaded from Redis at least every HISTORY_CACHE_MAX_AGE seconds.
+    HISTORY_CACHE_MODE = os.getenv("HISTORY_CACHE_MODE", "local")
+    HISTORY_CACHE_SIZE = int(os.getenv("HISTORY_CACHE_SIZE", "200"))
+    HISTORY_CACHE_MAX_AGE = float(os.getenv("HISTORY_CACHE_MAX_AGE", "60"))
+    
+    # History paging: clients get at most HISTORY_PAGE_MAX messages per request (HISTORY_PAGE_SIZE
+    # if they don't ask) and use the returned cursor for the next page. Streamed responses read
+    # Redis HISTORY_STREAM_CHUNK ids at a time.
+    HISTORY_PAGE_SIZE = int(os.getenv("HISTORY_PAGE_SIZE", "50"))
+    HISTORY_PAGE_MAX = int(os.getenv("HISTORY_PAGE_MAX", "200"))
+    HISTORY_STREAM_CHUNK = int(os.getenv("HISTORY_STREAM_CHUNK", "500"))
+    
+    # Connection admission control: new WebSockets are admitted at ADMISSION_RATE per second
+    # (bursts up to ADMISSION_BURST), at most ADMISSION_QUEUE_SIZE wait for a slot and the rest
+    # are told to retry later. MAX_CONNECTIONS caps connections per instance (0 = no cap).
+    ADMISSION_RATE = float(os.getenv("ADMISSION_RATE", "200"))
+    ADMISSION_BURST = int(os.getenv("ADMISSION_BURST", "400"))
+    ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE", "1000"))
+    MAX_CONNECTIONS = int(os.getenv("MAX_CONNECTIONS", "10000"))
+    
+    # Outbound WebSocket queue settings (per connection): at most SEND_QUEUE_SIZE messages
+    # and SEND_QUEUE_MAX_BYTES of encoded frames (UTF-8 JSON or MessagePack, as sent) may wait to be written
+    SEND_QUEUE_SIZE = int(os.getenv("SEND_QUEUE_SIZE", "256"))
+    SEND_QUEUE_MAX_BYTES = int(os.getenv("SEND_QUEUE_MAX_BYTES", str(1024 * 1024)))
+    # What to do when a client's queue is full: "drop_oldest", "drop_newest", "coalesce"
+    # (replace the backlog with a resync notice) or "disconnect" (close with 1013)
+    SEND_QUEUE_POLICY = os.getenv("SEND_QUEUE_POLICY", "drop_oldest")
+    # A single write that takes longer than this evicts the client (seconds)
+    SEND_TIMEOUT = float(os.getenv("SEND_TIMEOUT", "10"))
+    
+    # permessage-deflate for WebSocket frames, negotiated with clients that offer it. Frames
+    # smaller than WS_COMPRESSION_THRESHOLD bytes (most single chat messages) go uncompressed.
+    WS_COMPRESSION = os.getenv("WS_COMPRESSION", "True").lower() == "true"
+    WS_COMPRESSION_THRESHOLD = int(os.getenv("WS_COMPRESSION_THRESHOLD", "512"))
+    
+    # Application-level heartbeat (seconds): quiet clients are pinged about every HEARTBEAT_INTERVAL
+    # and closed once nothing has been heard from them for HEARTBEAT_TIMEOUT. Keep the interval
+    # below the ALB/nginx idle timeouts and the timeout above twice the interval.
+    HEARTBEAT_INTERVAL = float(os.getenv("HEARTBEAT_INTERVAL", "25"))
+    HEARTBEAT_TIMEOUT = float(os.getenv("HEARTBEAT_TIMEOUT", "60"))
+    HEARTBEAT_TICK = float(os.getenv("HEARTBEAT_TICK", "1"))
 
 settings = Settings()
\ No newline at end of file
@@ -0,0 +1,90 @@
+import json
+from typing import Any, Dict, Optional
+
+try:
+    import orjson  # Optional, noticeably faster than the stdlib encoder
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack  # Optional, enables the binary "msgpack" WebSocket subprotocol
+except ImportError:
+    msgpack = None
+
+# WebSocket subprotocol name clients offer to get MessagePack frames instead of JSON text
+MSGPACK_SUBPROTOCOL = "msgpack"
+
+
+def dumps(data: Any) -> str:
+    """Serialize data to a JSON string, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(data).decode("utf-8")
+    return json.dumps(data)
+
+
+def loads(raw) -> Any:
+    """Parse a JSON string or bytes, using orjson when it is available"""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def unpack(raw: bytes) -> Any:
+    """Parse a MessagePack frame from a client using the msgpack subprotocol"""
+    return msgpack.unpackb(raw)
+
+
+class MessageEnvelope:
+    """
+    A message together with its encoded form.
+    The JSON text is built at most once and then reused for every WebSocket
+    recipient, the Redis publish and history storage, so the data must not
+    be modified once the envelope has been handed out. The same goes for the
+    MessagePack form sent to msgpack clients.
+    """
+    # received_at: monotonic time this instance got the message, for the latency metrics
+    __slots__ = ("data", "_text", "_packed", "_text_size", "received_at")
+
+    def __init__(self, data: Dict[str, Any], text: Optional[str] = None, received_at: Optional[float] = None):
+        self.data = data
+        self._text = text
+        self._packed = None
+        self._text_size = None
+        self.received_at = received_at
+
+    @classmethod
+    def from_text(cls, text: str, received_at: Optional[float] = None) -> "MessageEnvelope":
+        """Wrap an already encoded message (e.g. from Redis) without re-encoding it"""
+        return cls(loads(text), text, received_at)
+
+    @classmethod
+    def wrap(cls, message) -> "MessageEnvelope":
+        """Return the message as an envelope, wrapping plain dicts"""
+        if isinstance(message, cls):
+            return message
+        return cls(message)
+
+    @property
+    def text(self) -> str:
+        if self._text is None:
+            self._text = dumps(self.data)
+        return self._text
+
+    @property
+    def packed(self) -> bytes:
+        if self._packed is None:
+            self._packed = msgpack.packb(self.data)
+        return self._packed
+
+    def size(self, binary: bool = False) -> int:
+        """Bytes the message takes on the wire: the MessagePack frame, or the UTF-8 encoded JSON text"""
+        if binary:
+            return len(self.packed)
+        if self._text_size is None:
+            text = self.text
+            self._text_size = len(text) if text.isascii() else len(text.encode("utf-8"))
+        return self._text_size
+
+    @property
+    def type(self) -> Optional[str]:
+        return self.data.get("type")
@@ -0,0 +1,112 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Set
+from prometheus_client import Counter
+from config import settings
+from websocket_manager import manager
+from redis_service import redis_service
+
+logger = logging.getLogger(__name__)
+
+# Heartbeat metrics
+heartbeat_pings = Counter(
+    "websocket_heartbeat_pings_total",
+    "Number of application-level pings sent to idle connections",
+    ["instance_id"]
+)
+heartbeat_reaped = Counter(
+    "websocket_reaped_connections_total",
+    "Number of connections closed because nothing was heard from them within HEARTBEAT_TIMEOUT",
+    ["instance_id"]
+)
+
+
+class Heartbeat:
+    """
+    Application-level ping/pong for every connection of the instance, driven
+    by one timer wheel instead of a keepalive task per socket.
+
+    The wheel has one slot per HEARTBEAT_TICK of HEARTBEAT_INTERVAL. A
+    connection is placed in the slot just behind the cursor, so it is visited
+    once per interval, and connections made at different times spread their
+    pings over the whole interval. On each visit a connection that has been
+    quiet for half an interval gets a ping, and one that has been quiet for
+    longer than HEARTBEAT_TIMEOUT is reaped. Any inbound message, including
+    the client's pong, counts as a sign of life (see ConnectionManager.touch).
+    The visit also refreshes the registry entries of the slot's live
+    connections, so entries of a node that dies expire soon after.
+    """
+
+    def __init__(self, interval: float, tick: float):
+        self.interval = interval
+        self.tick = tick
+        self.slots: List[Set[str]] = [set() for _ in range(max(1, round(interval / tick)))]
+        self.cursor = 0
+        # client_id -> index of the slot it is in
+        self.slot_of: Dict[str, int] = {}
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+        logger.info(f"Heartbeat started: {len(self.slots)} slots, ping every {self.interval}s")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def track(self, client_id: str):
+        """Start heartbeating a newly connected client (again, if it reconnected)"""
+        old_slot = self.slot_of.get(client_id)
+        if old_slot is not None:
+            self.slots[old_slot].discard(client_id)
+        # The slot just behind the cursor comes round again after one full interval
+        slot = (self.cursor - 1) % len(self.slots)
+        self.slots[slot].add(client_id)
+        self.slot_of[client_id] = slot
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                self.advance()
+            except Exception as e:
+                logger.error(f"Heartbeat tick failed: {e}")
+
+    def advance(self):
+        """Visit the connections in the current slot and move the cursor on"""
+        slot = self.slots[self.cursor]
+        now = time.monotonic()
+        alive = []
+        for client_id in list(slot):
+            connection = manager.active_connections.get(client_id)
+            if connection is None:
+                # Disconnected since it was tracked; forget it lazily
+                slot.discard(client_id)
+                self.slot_of.pop(client_id, None)
+                continue
+
+            idle = now - connection.last_seen
+            if idle > settings.HEARTBEAT_TIMEOUT:
+                logger.info(f"Reaping client {client_id}, silent for {idle:.0f}s")
+                heartbeat_reaped.labels(instance_id=settings.INSTANCE_ID).inc()
+                slot.discard(client_id)
+                self.slot_of.pop(client_id, None)
+                manager.reap(client_id)
+                continue
+            if idle >= self.interval / 2:
+                heartbeat_pings.labels(instance_id=settings.INSTANCE_ID).inc()
+                manager.send_ping(client_id)
+            alive.append(client_id)
+
+        if alive:
+            asyncio.create_task(redis_service.refresh_connections(alive))
+        self.cursor = (self.cursor + 1) % len(self.slots)
+
+
+# Create a global heartbeat instance
+heartbeat = Heartbeat(settings.HEARTBEAT_INTERVAL, settings.HEARTBEAT_TICK)
@@ -0,0 +1,88 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Dict, List
+from prometheus_client import Counter
+from config import settings
+from redis_service import redis_service
+
+logger = logging.getLogger(__name__)
+
+# Track how often history reads are served from memory
+history_cache_requests = Counter(
+    "history_cache_requests_total",
+    "Number of default-room history reads, by whether the in-memory cache served them",
+    ["instance_id", "result"]  # result: hit or miss
+)
+
+
+class HistoryCache:
+    """
+    Ring buffer of the newest messages of the default room, kept on each instance.
+
+    It is fed by every message this instance delivers locally, so it is only
+    trusted while the message bus is "live" for the default room (connected
+    and subscribed). While live, the first read primes it from Redis and later
+    reads are served from memory, re-priming at most every
+    HISTORY_CACHE_MAX_AGE seconds. Otherwise reads go to Redis.
+    HISTORY_CACHE_MODE=redis disables the cache entirely.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.messages: deque = deque(maxlen=size)
+        self.live = False
+        self.primed_at = None
+        self.prime_lock = asyncio.Lock()
+
+    def add(self, message: Dict[str, Any]):
+        """Record a chat message of the default room that was just delivered locally"""
+        if self.live:
+            self.messages.append(message)
+
+    def set_live(self, live: bool):
+        """Called by the message bus when the default-room feed starts or stops being complete"""
+        if live == self.live:
+            return
+        self.live = live
+        # Anything gathered before a gap can't be trusted; start over and re-prime on next read
+        self.messages.clear()
+        self.primed_at = None
+        logger.info(f"History cache {'enabled' if live else 'disabled'}")
+
+    def is_fresh(self) -> bool:
+        return self.primed_at is not None and time.monotonic() - self.primed_at < settings.HISTORY_CACHE_MAX_AGE
+
+    async def prime(self):
+        """Load the newest messages from Redis, keeping anything delivered while the load was in flight"""
+        async with self.prime_lock:
+            if self.is_fresh():
+                return
+            fetched = await redis_service.get_recent_messages(self.size, settings.DEFAULT_ROOM)
+            fetched.reverse()  # oldest first, like the live feed
+
+            known_ids = {message.get("message_id") for message in fetched}
+            merged = deque(fetched, maxlen=self.size)
+            merged.extend(m for m in self.messages if m.get("message_id") not in known_ids)
+            self.messages = merged
+            self.primed_at = time.monotonic()
+
+    async def get_recent(self, limit: int) -> List[Dict[str, Any]]:
+        """Newest messages of the default room first, like RedisService.get_recent_messages"""
+        if settings.HISTORY_CACHE_MODE == "redis" or not self.live or limit > self.size:
+            history_cache_requests.labels(instance_id=settings.INSTANCE_ID, result="miss").inc()
+            return await redis_service.get_recent_messages(limit, settings.DEFAULT_ROOM)
+
+        if not self.is_fresh():
+            history_cache_requests.labels(instance_id=settings.INSTANCE_ID, result="miss").inc()
+            await self.prime()
+        else:
+            history_cache_requests.labels(instance_id=settings.INSTANCE_ID, result="hit").inc()
+
+        messages = self.messages
+        return [messages[-i] for i in range(1, min(limit, len(messages)) + 1)]
+
+
+# Create a global history cache instance
+history_cache = HistoryCache(settings.HISTORY_CACHE_SIZE)
@@ -0,0 +1,68 @@
+import asyncio
+import logging
+import time
+from prometheus_client import Gauge, Histogram
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Event-loop responsiveness metrics
+event_loop_lag = Histogram(
+    "event_loop_lag_seconds",
+    "How late the event loop ran a timer; every WebSocket read and write waits at least this long",
+    ["instance_id"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+event_loop_max_lag = Gauge(
+    "event_loop_max_lag_seconds",
+    "Largest event loop lag seen in the last LOOP_LAG_REPORT_INTERVAL seconds",
+    ["instance_id"],
+    multiprocess_mode="livemax"
+)
+
+
+class LoopMonitor:
+    """
+    Measures event-loop lag: a timer asks to wake up every interval seconds and
+    records how much later than that it actually ran. Anything that holds the
+    loop (CPU-bound code, blocking calls) shows up directly as lag.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.max_lag = 0.0
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    async def run(self):
+        lag_histogram = event_loop_lag.labels(instance_id=settings.INSTANCE_ID)
+        max_lag_gauge = event_loop_max_lag.labels(instance_id=settings.INSTANCE_ID)
+        reported_at = time.monotonic()
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - started - self.interval)
+            lag_histogram.observe(lag)
+            self.max_lag = max(self.max_lag, lag)
+
+            if now - reported_at >= settings.LOOP_LAG_REPORT_INTERVAL:
+                max_lag_gauge.set(self.max_lag)
+                if self.max_lag >= settings.LOOP_LAG_WARNING:
+                    logger.warning(f"Event loop lagged up to {self.max_lag * 1000:.0f}ms")
+                self.max_lag = 0.0
+                reported_at = now
+
+
+# Create a global loop monitor instance
+loop_monitor = LoopMonitor(settings.LOOP_LAG_INTERVAL)
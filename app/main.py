@@ -1,23 +1,33 @@
-import asyncio
 import logging
+import math
+import os
+import re
+import sys
 import time
 import uuid
 import uvicorn
-import json
-from typing import Dict, Any, List
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, BackgroundTasks, Request
+from typing import Dict, Any, List, Optional
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from starlette.responses import PlainTextResponse
-from prometheus_client import generate_latest, CONTENT_TYPE_LATEST, Counter, Gauge
-import redis.asyncio as redis
+from prometheus_client import (
+    generate_latest, multiprocess, CollectorRegistry, CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge
+)
 
 from websocket_manager import manager
-from background_tasks import task_manager
-from redis_service import redis_service
+from background_tasks import TaskQuotaExceeded, TaskRejected, task_manager
+from redis_service import parse_cursor, redis_service
 from config import settings
 from models import TaskRequest, InstanceInfo
+from envelope import MSGPACK_SUBPROTOCOL, dumps, loads, msgpack, unpack
+from admission import admission
+from message_bus import message_bus, build_envelope
+from worker_bus import worker_bus
+from heartbeat import heartbeat
+from loop_monitor import loop_monitor
+from workers import SERVER_OPTIONS
 
 # Configure logging
 logging.basicConfig(
@@ -29,16 +39,21 @@ logger = logging.getLogger(__name__)
 # Initialize metrics
 http_requests = Counter("http_requests_total", "HTTP requests count", ["method", "endpoint", "status_code"])
 startup_time = time.time()
-uptime = Gauge("app_uptime_seconds", "Application uptime in seconds")
-
-# Redis Pub/Sub channels
-CHAT_CHANNEL = "chat_messages"
-SYSTEM_CHANNEL = "system_messages"
+uptime = Gauge("app_uptime_seconds", "Application uptime in seconds", multiprocess_mode="livemax")
 
-# Redis pub/sub client
-pubsub_redis = None
+# With several workers each process records its metrics in PROMETHEUS_MULTIPROC_DIR (see workers.py)
+# and any of them serves the combined values; otherwise the default registry has them all
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    metrics_registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(metrics_registry)
+else:
+    metrics_registry = REGISTRY
 
+# Room names double as Redis channel and key suffixes
+ROOM_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
 
+# Fields of a client frame that must be strings when present
+FRAME_TEXT_FIELDS = ("type", "room", "content", "target_client_id", "history_type")
 
 # Create FastAPI application
 app = FastAPI(
@@ -62,26 +77,33 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 # Startup and shutdown events
 @app.on_event("startup")
 async def startup_event():
-    global pubsub_redis
     logger.info(f"Starting up {settings.APP_NAME}")
     logger.info(f"Instance ID: {settings.INSTANCE_ID}")
+    if settings.WORKERS > 1:
+        logger.info(f"Worker ID: {settings.WORKER_ID}")
+    if settings.TASK_DEFAULT_PRIORITY not in settings.TASK_PRIORITY_WEIGHTS:
+        # Every task created without a priority would be rejected
+        raise RuntimeError(
+            f"TASK_DEFAULT_PRIORITY {settings.TASK_DEFAULT_PRIORITY} is not one of "
+            f"the TASK_PRIORITY_WEIGHTS classes {list(settings.TASK_PRIORITY_WEIGHTS)}"
+        )
+    
+    # Sibling workers fan out to each other locally, with or without Redis
+    await worker_bus.start(worker_stats)
+    heartbeat.start()
+    loop_monitor.start()
     
     # Initialize Redis connection
     try:
         await redis_service.initialize()
+        redis_service.start_message_writer()
         logger.info("Redis connection established")
         
-        # Initialize Redis pub/sub
-        pubsub_redis = redis.Redis(
-            host=settings.REDIS_HOST,
-            port=settings.REDIS_PORT,
-            db=settings.REDIS_DB,
-            decode_responses=True
-        )
+        # Initialize Redis pub/sub and start listening to the channels
+        await message_bus.start()
         
-        # Start listening to Redis channels
-        asyncio.create_task(redis_listener())
-        logger.info("Redis pub/sub listener started")
+        # Start claiming background tasks from the shared queue
+        await task_manager.start(deliver_task_result, deliver_task_progress)
         
     except Exception as e:
         logger.error(f"Failed to initialize Redis: {e}")
@@ -89,43 +111,23 @@ async def startup_event():
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info(f"Shutting down {settings.APP_NAME}")
-    if pubsub_redis:
-        await pubsub_redis.close()
-
-async def redis_listener():
-    """Listen to Redis pub/sub channels and broadcast to WebSocket clients"""
-    try:
-        pubsub = pubsub_redis.pubsub()
-        await pubsub.subscribe(CHAT_CHANNEL, SYSTEM_CHANNEL)
-        
-        logger.info(f"Subscribed to Redis channels: {CHAT_CHANNEL}, {SYSTEM_CHANNEL}")
-        
-        async for message in pubsub.listen():
-            if message['type'] == 'message':
-                try:
-                    data = json.loads(message['data'])
-                    # Don't re-broadcast messages from the same instance
-                    if data.get('source_instance') != settings.INSTANCE_ID:
-                        await manager.broadcast(data)
-                        logger.debug(f"Broadcasted message from Redis: {data['type']}")
-                except json.JSONDecodeError:
-                    logger.error(f"Failed to decode Redis message: {message['data']}")
-                except Exception as e:
-                    logger.error(f"Error processing Redis message: {e}")
-                    
-    except Exception as e:
-        logger.error(f"Redis listener error: {e}")
+    await heartbeat.stop()
+    await loop_monitor.stop()
+    # Hand unfinished tasks back to the queue while Redis is still reachable
+    await task_manager.stop()
+    await message_bus.stop()
+    await worker_bus.stop()
+    
+    # Flush any buffered history writes before the ALB drains us
+    await redis_service.close()
 
-async def publish_to_redis(channel: str, data: dict):
-    """Publish message to Redis channel"""
-    try:
-        # Add source instance to avoid re-broadcasting
-        data['source_instance'] = settings.INSTANCE_ID
-        message = json.dumps(data)
-        await pubsub_redis.publish(channel, message)
-        logger.debug(f"Published to Redis channel {channel}: {data['type']}")
-    except Exception as e:
-        logger.error(f"Failed to publish to Redis: {e}")
+def worker_stats() -> Dict[str, Any]:
+    """This worker's counts, shared with sibling workers for /instance"""
+    return {
+        "worker_id": settings.WORKER_ID,
+        "connection_count": manager.connection_count,
+        "active_tasks": task_manager.active_task_count
+    }
 
 # Root endpoint serving frontend
 @app.get("/")
@@ -135,8 +137,24 @@ async def get_root():
 # Health check endpoint
 @app.get("/health")
 async def health_check():
+    bus_health = message_bus.health()
+    connection_health = admission.get_stats(manager.connection_count)
+    content = {
+        "status": "healthy",
+        "instance_id": settings.INSTANCE_ID,
+        "message_bus": bus_health,
+        "connections": connection_health
+    }
+    
+    # Report unhealthy when cut off from the other instances, or when full,
+    # so the ALB stops routing new connections here
+    if not bus_health["healthy"] or connection_health["saturated"]:
+        content["status"] = "unhealthy" if not bus_health["healthy"] else "saturated"
+        http_requests.labels(method="GET", endpoint="/health", status_code=503).inc()
+        return JSONResponse(status_code=503, content=content)
+    
     http_requests.labels(method="GET", endpoint="/health", status_code=200).inc()
-    return {"status": "healthy", "instance_id": settings.INSTANCE_ID}
+    return content
 
 # Instance information endpoint
 @app.get("/instance", response_model=InstanceInfo)
@@ -145,18 +163,22 @@ async def instance_info():
     uptime_value = time.time() - startup_time
     uptime.set(uptime_value)
     
+    # Totals cover every worker process of this instance
+    workers = [worker_stats()] + worker_bus.live_sibling_stats()
     return {
         "instance_id": settings.INSTANCE_ID,
         "uptime": uptime_value,
-        "connection_count": manager.connection_count,
-        "active_tasks": task_manager.active_task_count
+        "connection_count": sum(worker["connection_count"] for worker in workers),
+        "active_tasks": sum(worker["active_tasks"] for worker in workers),
+        "worker_id": settings.WORKER_ID,
+        "workers": sorted(workers, key=lambda worker: worker["worker_id"])
     }
 
 # Metrics endpoint
 @app.get("/metrics")
 async def metrics():
     http_requests.labels(method="GET", endpoint="/metrics", status_code=200).inc()
-    return PlainTextResponse(generate_latest().decode(), media_type=CONTENT_TYPE_LATEST)
+    return PlainTextResponse(generate_latest(metrics_registry).decode(), media_type=CONTENT_TYPE_LATEST)
 
 # Helper function to get client IP
 def get_client_ip(websocket: WebSocket) -> str:
@@ -167,17 +189,75 @@ def get_client_ip(websocket: WebSocket) -> str:
         return host if host else "unknown"
     return "unknown"
 
+def page_limit(limit) -> int:
+    """Clamp a client-supplied history page size to the server-side maximum"""
+    if limit is None:
+        return settings.HISTORY_PAGE_SIZE
+    return max(1, min(int(limit), settings.HISTORY_PAGE_MAX))
+
+def message_timestamp(value) -> float:
+    """A client-supplied message timestamp as a finite float, or the server time if it isn't one"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        value = float(value)
+        if math.isfinite(value):
+            return value
+    return time.time()
+
+def choose_subprotocol(websocket: WebSocket):
+    """Speak MessagePack if the client offers it and msgpack is installed, JSON text otherwise"""
+    if msgpack is not None and MSGPACK_SUBPROTOCOL in websocket.scope.get("subprotocols", []):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+async def receive_message(websocket: WebSocket) -> Any:
+    """Receive one client message, JSON text or MessagePack binary; None if it can't be decoded"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    try:
+        if message.get("bytes") is not None:
+            return unpack(message["bytes"])
+        return loads(message["text"])
+    except (TypeError, ValueError):
+        return None
+
+def frame_error(data: Any) -> Optional[str]:
+    """Why a client frame can't be handled, or None if it is an object whose text fields are strings"""
+    if not isinstance(data, dict):
+        return "expected a JSON or MessagePack object"
+    for field in FRAME_TEXT_FIELDS:
+        if data.get(field) is not None and not isinstance(data[field], str):
+            return f"{field} must be a string"
+    return None
+
+async def reject_connection(websocket: WebSocket, retry_after: float):
+    """Accept just long enough to tell the client when to retry, then close with 1013 (try again later)"""
+    try:
+        await websocket.accept()
+        await websocket.send_text(dumps({
+            "type": "retry_after",
+            "retry_after": retry_after,
+            "instance_id": settings.INSTANCE_ID
+        }))
+        await websocket.close(code=1013)
+    except Exception as e:
+        logger.debug(f"Error rejecting connection: {e}")
+
 # WebSocket endpoint
 @app.websocket("/ws/{client_id}")
 async def websocket_endpoint(websocket: WebSocket, client_id: str):
     # Get the client's IP address
     client_ip = get_client_ip(websocket)
     
-    # Connect with IP information
-    await manager.connect(websocket, client_id, client_ip)
+    # Pace connection bursts; clients that can't be admitted are told when to retry
+    retry_after = await admission.acquire(manager.connection_count)
+    if retry_after is not None:
+        await reject_connection(websocket, retry_after)
+        return
     
-    # Get user message history
-    user_history = await manager.get_user_history(client_id, 20)
+    # Connect with IP information
+    await manager.connect(websocket, client_id, client_ip, choose_subprotocol(websocket))
+    heartbeat.track(client_id)
     
     # Send initial connection info
     await manager.send_personal_message({
@@ -188,52 +268,128 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
         "client_ip": client_ip
     }, client_id)
     
-    # Send message history if available
-    if user_history:
+    # A reconnecting client can resume from the last stream id it saw instead of reloading history
+    resumed = None
+    resume_from = websocket.query_params.get("resume_from")
+    if resume_from:
+        resumed = await message_bus.replay(settings.DEFAULT_ROOM, resume_from, settings.STREAM_RESUME_LIMIT)
+    
+    if resumed is not None:
         await manager.send_personal_message({
             "type": "message_history",
-            "messages": user_history,
-            "source": "user_history"
+            "messages": resumed,
+            "source": "resume"
         }, client_id)
     else:
-        # If no user history, send global history
-        global_history = await manager.get_chat_history(20)
-        if global_history:
-            await manager.send_personal_message({
-                "type": "message_history",
-                "messages": global_history,
-                "source": "global_history"
-            }, client_id)
+        await send_initial_history(client_id)
     
     try:
         while True:
             # Wait for messages from the client
-            data = await websocket.receive_json()
+            data = await receive_message(websocket)
+            
+            # Evicted, reaped or replaced by a newer connection with the same id while we
+            # waited; the close is on its way and this socket no longer speaks for the client
+            connection = manager.active_connections.get(client_id)
+            if connection is None or connection.websocket is not websocket:
+                break
+            manager.touch(client_id)
+            
+            error = frame_error(data)
+            if error is not None:
+                await manager.send_personal_message({
+                    "type": "system",
+                    "content": f"Invalid message: {error}",
+                    "instance_id": settings.INSTANCE_ID
+                }, client_id)
+                continue
             
             message_type = data.get("type", "chat")
             
             if message_type == "chat":
+                received_at = time.monotonic()
+                room = data.get("room") or settings.DEFAULT_ROOM
+                if room not in connection.rooms:
+                    await manager.send_personal_message({
+                        "type": "system",
+                        "content": f"You are not in room {room}",
+                        "instance_id": settings.INSTANCE_ID
+                    }, client_id)
+                    continue
+                
                 # Process chat message
-                message = {
+                message = build_envelope({
                     "type": "chat",
                     "client_id": client_id,
                     "client_ip": client_ip,  # Include client IP in the message
                     "content": data.get("content", ""),
+                    "message_id": uuid.uuid4().hex,
+                    "room": room,
                     "instance_id": settings.INSTANCE_ID,
-                    "timestamp": data.get("timestamp") or time.time()
-                }
+                    "timestamp": message_timestamp(data.get("timestamp"))
+                }, received_at)
+                
+                # Persist once here, at the originating instance
+                manager.persist_message(message, client_id)
                 
-                # Broadcast message to local clients first
-                await manager.broadcast(message)
+                # Deliver to local clients and the other instances
+                await message_bus.send(message)
+                
+            elif message_type in ("join_room", "leave_room"):
+                room = data.get("room") or ""
+                if not ROOM_NAME_PATTERN.match(room):
+                    await manager.send_personal_message({
+                        "type": "system",
+                        "content": f"Invalid room name: {room}",
+                        "instance_id": settings.INSTANCE_ID
+                    }, client_id)
+                    continue
+                
+                if message_type == "join_room":
+                    manager.join_room(client_id, room)
+                else:
+                    manager.leave_room(client_id, room)
                 
-                # Publish to Redis for other instances
-                await publish_to_redis(CHAT_CHANNEL, message)
-                await publish_to_redis(CHAT_CHANNEL, message)  # Publish to Redis channel
+                await manager.send_personal_message({
+                    "type": "room_joined" if message_type == "join_room" else "room_left",
+                    "room": room,
+                    "instance_id": settings.INSTANCE_ID
+                }, client_id)
+
+            elif message_type == "pong":
+                # Reply to a heartbeat ping; touch() above already recorded it
+                pass
+                
+            elif message_type == "direct_message":
+                # Private message to one client, routed to the node it is connected to
+                message = {
+                    "type": "direct_message",
+                    "client_id": client_id,
+                    "target_client_id": data.get("target_client_id", ""),
+                    "content": data.get("content", ""),
+                    "message_id": uuid.uuid4().hex,
+                    "instance_id": settings.INSTANCE_ID,
+                    "timestamp": message_timestamp(data.get("timestamp"))
+                }
+                delivered = await message_bus.send_direct(message["target_client_id"], message)
                 
+                # Echo back to the sender so it knows whether the message went anywhere
+                await manager.send_personal_message({**message, "delivered": delivered}, client_id)
 
             elif message_type == "task_request":
-                # Handle background task request
-                task_id, task_info = await task_manager.create_task(client_id)
+                # Queue a background task; whichever node has a free worker runs it
+                handler = data.get("handler") or "sleep"
+                priority = data.get("priority") or settings.TASK_DEFAULT_PRIORITY
+                try:
+                    if not isinstance(handler, str) or not isinstance(priority, str):
+                        raise ValueError("handler and priority must be strings")
+                    task_id, task_info = await task_manager.create_task(client_id, handler, data.get("params"), priority)
+                except (TaskRejected, ValueError) as e:
+                    await manager.send_personal_message({
+                        "type": "task_rejected",
+                        "reason": str(e)
+                    }, client_id)
+                    continue
                 
                 # Notify client that task was created
                 await manager.send_personal_message({
@@ -242,83 +398,196 @@ async def websocket_endpoint(websocket: WebSocket, client_id: str):
                     "details": task_info
                 }, client_id)
                 
-                # Run the task in the background
-                asyncio.create_task(process_background_task(task_id, client_id))
-                
             elif message_type == "get_history":
-                # Request for message history
-                limit = data.get("limit", 50)
+                # Request for a page of message history; "cursor" continues from an earlier page
                 history_type = data.get("history_type", "user")
-                
-                if history_type == "user":
-                    messages = await manager.get_user_history(client_id, limit)
-                else:
-                    messages = await manager.get_chat_history(limit)
+                try:
+                    limit = page_limit(data.get("limit"))
+                    if history_type == "user":
+                        messages, cursor = await manager.get_user_history(client_id, limit, data.get("cursor"))
+                    else:
+                        messages, cursor = await manager.get_chat_history(
+                            limit, data.get("room") or settings.DEFAULT_ROOM, data.get("cursor")
+                        )
+                except (TypeError, ValueError) as e:
+                    await manager.send_personal_message({
+                        "type": "system",
+                        "content": f"Invalid history request: {e}",
+                        "instance_id": settings.INSTANCE_ID
+                    }, client_id)
+                    continue
                 
                 await manager.send_personal_message({
                     "type": "message_history",
                     "messages": messages,
-                    "source": history_type + "_history"
+                    "source": history_type + "_history",
+                    "next_cursor": cursor
                 }, client_id)
                 
     except WebSocketDisconnect:
-        manager.disconnect(client_id)
-        disconnect_message = {
+        manager.disconnect(client_id, websocket)
+        disconnect_message = build_envelope({
             "type": "system",
             "content": f"Client #{client_id} left the chat",
             "instance_id": settings.INSTANCE_ID
-        }
+        })
         
         # Broadcast locally and to other instances
-        await manager.broadcast(disconnect_message)
-        await publish_to_redis(SYSTEM_CHANNEL, disconnect_message)
+        await message_bus.send(disconnect_message)
+    finally:
+        # Don't leave the connection registered if the loop died some other way; a no-op after the above
+        manager.disconnect(client_id, websocket)
 
-async def process_background_task(task_id: str, client_id: str):
-    # Run the task
-    task_id, task_result = await task_manager.run_task(task_id)
+async def send_initial_history(client_id: str):
+    # Get user message history
+    user_history, cursor = await manager.get_user_history(client_id, 20)
     
-    # Notify client when task is complete
-    if task_result:
+    # Send message history if available
+    if user_history:
         await manager.send_personal_message({
-            "type": "task_completed",
-            "task_id": task_id,
-            "details": task_result
+            "type": "message_history",
+            "messages": user_history,
+            "source": "user_history",
+            "next_cursor": cursor
         }, client_id)
+    else:
+        # If no user history, send global history
+        global_history, _ = await manager.get_chat_history(20, cached=True)
+        if global_history:
+            await manager.send_personal_message({
+                "type": "message_history",
+                "messages": global_history,
+                "source": "global_history"
+            }, client_id)
+
+async def deliver_task_result(task_id: str, task_result: Dict[str, Any]):
+    # Notify the client when its task is complete, on whichever node it is connected to by now
+    await message_bus.send_direct(task_result["client_id"], {
+        "type": "task_completed",
+        "task_id": task_id,
+        "details": task_result
+    })
+
+async def deliver_task_progress(task_id: str, client_id: str, update: Dict[str, Any]):
+    # Progress and partial results of a running task, already rate-limited by the task manager
+    await message_bus.send_direct(client_id, {
+        "type": "task_progress",
+        "task_id": task_id,
+        **update
+    })
 
 # Background task endpoint
 @app.post("/tasks")
-async def create_task(request: TaskRequest, background_tasks: BackgroundTasks):
-    http_requests.labels(method="POST", endpoint="/tasks", status_code=200).inc()
-    
+async def create_task(request: TaskRequest):
     client_id = request.client_id
-    task_id, task_info = await task_manager.create_task(client_id)
-    
-    # Run the task in the background
-    background_tasks.add_task(process_background_task, task_id, client_id)
+    try:
+        task_id, task_info = await task_manager.create_task(client_id, request.handler, request.params, request.priority)
+    except ValueError as e:
+        http_requests.labels(method="POST", endpoint="/tasks", status_code=400).inc()
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    except TaskQuotaExceeded as e:
+        http_requests.labels(method="POST", endpoint="/tasks", status_code=429).inc()
+        return JSONResponse(status_code=429, content={"detail": str(e)})
+    except TaskRejected as e:
+        http_requests.labels(method="POST", endpoint="/tasks", status_code=503).inc()
+        return JSONResponse(status_code=503, content={"detail": str(e)})
     
+    http_requests.labels(method="POST", endpoint="/tasks", status_code=200).inc()
     return {"task_id": task_id, "details": task_info}
 
+# Task status endpoint
+@app.get("/tasks/{task_id}")
+async def get_task(task_id: str):
+    task = await task_manager.get_task(task_id)
+    if task is None:
+        http_requests.labels(method="GET", endpoint="/tasks/{task_id}", status_code=404).inc()
+        return JSONResponse(status_code=404, content={"detail": "Task not found"})
+    
+    http_requests.labels(method="GET", endpoint="/tasks/{task_id}", status_code=200).inc()
+    return {"task_id": task_id, "details": task}
+
 # Chat history endpoint
 @app.get("/chat/history")
-async def get_chat_history(request: Request, limit: int = 50, history_type: str = "global"):
-    http_requests.labels(method="GET", endpoint="/chat/history", status_code=200).inc()
-    
+async def get_chat_history(
+    request: Request,
+    limit: Optional[int] = None,
+    history_type: str = "global",
+    room: str = settings.DEFAULT_ROOM,
+    cursor: Optional[str] = None,
+    stream: bool = False,
+    consistent: bool = False
+):
+    """
+    A page of at most HISTORY_PAGE_MAX messages, newest first, with the cursor of the next
+    page. The first global page comes from the instance's history cache and has no next
+    cursor; consistent=true reads it from Redis instead, with a cursor to page on from.
+    With stream=true every message older than the cursor is streamed instead, read
+    from Redis in chunks; limit is ignored then.
+    """
     client_ip = request.client.host if request.client else "unknown"
     client_id = request.query_params.get("client_id", "api-client")
     
     if history_type == "global":
-        messages = await redis_service.get_recent_messages(limit)
+        key = redis_service.room_key(room)
     else:
-        user_id = redis_service.get_user_id(client_id, client_ip)
-        messages = await redis_service.get_user_messages(user_id, limit)
+        key = redis_service.user_key(redis_service.get_user_id(client_id, client_ip))
+    
+    try:
+        if stream:
+            parse_cursor(cursor)
+        elif history_type == "global":
+            messages, next_page = await manager.get_chat_history(page_limit(limit), room, cursor, cached=not consistent)
+        else:
+            messages, next_page = await redis_service.get_history_page(key, page_limit(limit), cursor)
+    except ValueError as e:
+        http_requests.labels(method="GET", endpoint="/chat/history", status_code=400).inc()
+        return JSONResponse(status_code=400, content={"detail": str(e)})
+    
+    http_requests.labels(method="GET", endpoint="/chat/history", status_code=200).inc()
+    if stream:
+        return StreamingResponse(stream_history(key, cursor, history_type), media_type="application/json")
     
     return {
         "messages": messages,
         "count": len(messages),
-        "history_type": history_type
+        "history_type": history_type,
+        "next_cursor": next_page
     }
 
+async def stream_history(key: str, cursor: Optional[str], history_type: str):
+    """Write a history response piece by piece; stored bodies are already JSON and are passed through"""
+    yield f'{{"history_type": {dumps(history_type)}, "messages": ['
+    separator = ""
+    async for bodies in redis_service.iter_history(key, cursor):
+        yield separator + ",".join(bodies)
+        separator = ","
+    yield "]}"
+
+# History export endpoint
+@app.get("/chat/export")
+async def export_chat_history(room: str = settings.DEFAULT_ROOM, user_id: Optional[str] = None):
+    """
+    Stream a room's whole history (or a user's, given user_id) as NDJSON, oldest first.
+    Redis is read in chunks, so memory use does not depend on the size of the export.
+    """
+    http_requests.labels(method="GET", endpoint="/chat/export", status_code=200).inc()
+    
+    key = redis_service.user_key(user_id) if user_id else redis_service.room_key(room)
+    filename = f"{key.replace(':', '-')}.ndjson"
+    return StreamingResponse(
+        export_history(key),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def export_history(key: str):
+    # Stored bodies are single-line JSON, so each one is already an NDJSON record
+    async for bodies in redis_service.iter_history(key, oldest_first=True):
+        yield "\n".join(bodies) + "\n"
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    # Worker processes must not inherit an imported app, so hand multi-worker mode to the launcher
+    if settings.WORKERS > 1:
+        os.execv(sys.executable, [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "workers.py")])
+    uvicorn.run("main:app", host=settings.HOST, port=settings.PORT, reload=settings.DEBUG, **SERVER_OPTIONS)
\ No newline at end of file
@@ -0,0 +1,522 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+from prometheus_client import Counter, Gauge, Histogram
+from config import settings
+from envelope import MessageEnvelope, dumps, loads
+from websocket_manager import manager
+from redis_service import redis_service, redis_timer
+from history_cache import history_cache
+from worker_bus import worker_bus
+from background_tasks import node_key
+
+logger = logging.getLogger(__name__)
+
+# Bus health metrics
+bus_connected = Gauge(
+    "message_bus_connected",
+    "Whether the cross-instance message bus listener is connected (1) or not (0)",
+    ["instance_id"],
+    multiprocess_mode="livemin"
+)
+bus_reconnects = Counter(
+    "message_bus_reconnects_total",
+    "Number of times the message bus listener reconnected after losing Redis",
+    ["instance_id"]
+)
+bus_disconnected_seconds = Counter(
+    "message_bus_disconnected_seconds_total",
+    "Time the message bus listener spent disconnected from Redis",
+    ["instance_id"]
+)
+direct_messages = Counter(
+    "direct_messages_total",
+    "Number of messages addressed to a single client, by how they were delivered",
+    ["instance_id", "result"]  # result: local, routed or undeliverable
+)
+bus_propagation = Histogram(
+    "message_bus_propagation_seconds",
+    "Delay between another instance sending a message and this one receiving it from Redis, "
+    "by wall clock (so it includes any clock skew between the hosts)",
+    ["instance_id"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+# Redis Pub/Sub channels. Chat traffic is sharded into one channel per room.
+CHAT_CHANNEL = "chat_messages"
+SYSTEM_CHANNEL = "system_messages"
+
+# Redis Streams used by the "streams" transport, one per room plus one for system messages
+CHAT_STREAM = "stream:chat"
+SYSTEM_STREAM = "stream:system"
+
+
+def room_channel(room: str) -> str:
+    """Name of the pub/sub channel carrying a room's chat messages"""
+    return f"{CHAT_CHANNEL}:{room}"
+
+
+def room_stream(room: str) -> str:
+    """Name of the stream carrying a room's chat messages"""
+    return f"{CHAT_STREAM}:{room}"
+
+
+def inbox_channel(node_id: str) -> str:
+    """Pub/sub channel carrying direct messages for the clients of one node (worker)"""
+    return f"inbox:{node_id}"
+
+
+def inbox_stream(node_id: str) -> str:
+    """Stream carrying direct messages for the clients of one node (worker)"""
+    return f"stream:inbox:{node_id}"
+
+
+def stream_id(entry_id: str) -> Tuple[int, int]:
+    """A stream entry id "<ms>-<seq>" as a tuple that compares in stream order; raises ValueError if malformed"""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+def build_envelope(data: dict, received_at: Optional[float] = None) -> MessageEnvelope:
+    """Tag a locally created message with its source instance and send time and wrap it for encoding"""
+    # Add source instance to avoid re-broadcasting
+    data['source_instance'] = settings.INSTANCE_ID
+    # "timestamp" may come from the client's clock; receivers measure propagation from this
+    data['sent_at'] = time.time()
+    return MessageEnvelope(data, received_at=received_at)
+
+
+def observe_propagation(data: dict):
+    """Record how long a message from another instance took to get here through Redis"""
+    sent_at = data.get('sent_at')
+    if sent_at is not None and data.get('source_instance') != settings.INSTANCE_ID:
+        bus_propagation.labels(instance_id=settings.INSTANCE_ID).observe(max(0.0, time.time() - sent_at))
+
+
+class MessageBus:
+    """
+    Base class for the cross-instance message bus.
+    Instances only follow the rooms that at least one of their local
+    connections has joined, so inter-node traffic follows interest.
+    """
+
+    def __init__(self):
+        self.redis = None
+        self.listener_task = None
+        self.subscribed_rooms: Set[str] = set()
+        self.subscription_lock = asyncio.Lock()
+        self.connected = False
+        # Monotonic time the listener lost (or has not yet made) its connection
+        self.disconnected_since: Optional[float] = time.monotonic()
+        # How much of the current disconnection bus_disconnected_seconds already counts
+        self.disconnected_counted_at: Optional[float] = self.disconnected_since
+        self.reconnect_count = 0
+        self.ever_connected = False
+
+    async def start(self):
+        # Share RedisService's connection pool instead of opening a second client
+        self.redis = redis_service.redis
+
+        # Follow the rooms joined by local connections
+        manager.add_room_listener(self.on_rooms_changed)
+
+        self.listener_task = asyncio.create_task(self.supervise())
+        logger.info(f"Message bus listener started ({settings.BUS_TRANSPORT})")
+
+    async def supervise(self):
+        """Keep the listener running, reconnecting and resubscribing with exponential backoff"""
+        delay = settings.BUS_RECONNECT_MIN_DELAY
+        while True:
+            try:
+                # Hold the lock so room changes don't race the new connection's handshake
+                async with self.subscription_lock:
+                    await self.connect()
+                self._mark_connected()
+                await self.sync_subscriptions()
+                delay = settings.BUS_RECONNECT_MIN_DELAY
+
+                await self.listen()
+                raise ConnectionError("listener stopped")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._mark_disconnected()
+                self._count_disconnected()
+                logger.error(f"Message bus listener error: {e}. Reconnecting in {delay:.1f}s")
+
+            # Jitter so a fleet that lost Redis together doesn't reconnect in lockstep
+            await asyncio.sleep(delay * random.uniform(0.5, 1.0))
+            delay = min(delay * 2, settings.BUS_RECONNECT_MAX_DELAY)
+
+    def _count_disconnected(self):
+        """Add the time spent disconnected since the last call, so an ongoing outage shows up in rate()"""
+        now = time.monotonic()
+        if self.ever_connected and self.disconnected_counted_at is not None:
+            bus_disconnected_seconds.labels(instance_id=settings.INSTANCE_ID).inc(now - self.disconnected_counted_at)
+        self.disconnected_counted_at = now
+
+    def _mark_connected(self):
+        self._count_disconnected()
+        if self.ever_connected:
+            self.reconnect_count += 1
+            bus_reconnects.labels(instance_id=settings.INSTANCE_ID).inc()
+            logger.info("Message bus reconnected")
+        self.ever_connected = True
+        self.connected = True
+        self.disconnected_since = None
+        self.disconnected_counted_at = None
+        bus_connected.labels(instance_id=settings.INSTANCE_ID).set(1)
+
+    def _mark_disconnected(self):
+        if self.connected:
+            self.connected = False
+            self.disconnected_since = self.disconnected_counted_at = time.monotonic()
+        bus_connected.labels(instance_id=settings.INSTANCE_ID).set(0)
+        self._update_history_cache()
+
+    def health(self) -> Dict[str, Any]:
+        """
+        Bus status for /health. The bus is unhealthy once it has been disconnected
+        for longer than BUS_UNHEALTHY_AFTER, so the ALB can drain this node
+        instead of serving a split-brain chat.
+        """
+        disconnected_for = 0.0
+        if self.disconnected_since is not None:
+            disconnected_for = time.monotonic() - self.disconnected_since
+        return {
+            "transport": settings.BUS_TRANSPORT,
+            "connected": self.connected,
+            "disconnected_for": round(disconnected_for, 3),
+            "reconnects": self.reconnect_count,
+            "healthy": self.connected or disconnected_for < settings.BUS_UNHEALTHY_AFTER
+        }
+
+    async def stop(self):
+        # The shared client itself is closed by RedisService
+        if self.listener_task:
+            self.listener_task.cancel()
+            try:
+                await self.listener_task
+            except asyncio.CancelledError:
+                pass
+
+    def on_rooms_changed(self):
+        """Called by the ConnectionManager whenever a room gains its first or loses its last local member"""
+        if self.redis is not None:
+            asyncio.create_task(self.sync_subscriptions())
+
+    async def sync_subscriptions(self):
+        """Follow newly joined rooms and stop following rooms nobody here is in any more"""
+        async with self.subscription_lock:
+            wanted = manager.local_rooms()
+            joined = wanted - self.subscribed_rooms
+            left = self.subscribed_rooms - wanted
+
+            try:
+                if joined:
+                    await self.subscribe_rooms(joined)
+                    logger.info(f"Subscribed to rooms: {', '.join(sorted(joined))}")
+                if left:
+                    await self.unsubscribe_rooms(left)
+                    logger.info(f"Unsubscribed from rooms: {', '.join(sorted(left))}")
+                self.subscribed_rooms = (self.subscribed_rooms | joined) - left
+            except Exception as e:
+                logger.error(f"Failed to update room subscriptions: {e}")
+            
+            self._update_history_cache()
+
+    def _update_history_cache(self):
+        # The history cache is only complete while we receive every default-room message
+        history_cache.set_live(self.connected and settings.DEFAULT_ROOM in self.subscribed_rooms)
+
+    async def send(self, envelope: MessageEnvelope):
+        """Deliver an envelope built by build_envelope to local clients and every other instance"""
+        raise NotImplementedError
+
+    async def send_direct(self, client_id: str, message) -> bool:
+        """
+        Deliver a message to one client wherever it is connected.
+        The connection registry names the client's node, so the message goes
+        to that node's inbox only. Returns False if the client isn't connected
+        anywhere (as far as the registry knows).
+        """
+        envelope = MessageEnvelope.wrap(message)
+        if manager.is_local(client_id):
+            await manager.send_personal_message(envelope, client_id)
+            direct_messages.labels(instance_id=settings.INSTANCE_ID, result="local").inc()
+            return True
+        
+        node_id = await redis_service.lookup_connection(client_id)
+        delivered = False
+        if node_id is not None and node_id != settings.WORKER_ID:
+            frame = dumps({"client_id": client_id, "message": envelope.data})
+            # Sibling workers are reached directly; other nodes through their Redis inbox
+            delivered = worker_bus.send_direct(node_id, frame) or await self.send_to_inbox(node_id, frame)
+        
+        direct_messages.labels(
+            instance_id=settings.INSTANCE_ID,
+            result="routed" if delivered else "undeliverable"
+        ).inc()
+        if not delivered:
+            logger.debug(f"Direct message for client {client_id} could not be delivered")
+        return delivered
+
+    async def deliver_inbox(self, frame: str):
+        """Hand a direct message that arrived in this node's inbox to its client, or a sibling's broadcast to ours"""
+        try:
+            data = loads(frame)
+            if "broadcast" in data:
+                await manager.broadcast(MessageEnvelope(data["broadcast"], received_at=time.monotonic()))
+                return
+            await manager.send_personal_message(data["message"], data["client_id"])
+        except Exception as e:
+            logger.error(f"Failed to deliver direct message: {e}")
+
+    async def send_to_inbox(self, node_id: str, frame: str) -> bool:
+        raise NotImplementedError
+
+    async def replay(self, room: str, after_id: str, limit: int) -> Optional[List[dict]]:
+        """Return the messages of a room published after after_id, or None if the transport can't replay"""
+        return None
+
+    async def connect(self):
+        raise NotImplementedError
+
+    async def subscribe_rooms(self, rooms: Set[str]):
+        raise NotImplementedError
+
+    async def unsubscribe_rooms(self, rooms: Set[str]):
+        raise NotImplementedError
+
+    async def listen(self):
+        raise NotImplementedError
+
+
+class PubSubMessageBus(MessageBus):
+    """Fire-and-forget transport on Redis pub/sub, with one channel per room"""
+
+    def __init__(self):
+        super().__init__()
+        self.pubsub = None
+
+    async def connect(self):
+        if self.pubsub is not None:
+            try:
+                await self.pubsub.close()
+            except Exception:
+                pass
+        self.pubsub = redis_service.pubsub()
+        # A new pub/sub connection starts without subscriptions; resubscribe everything
+        self.subscribed_rooms = set()
+        await self.pubsub.subscribe(SYSTEM_CHANNEL, inbox_channel(settings.WORKER_ID))
+        logger.info(f"Subscribed to Redis channels: {SYSTEM_CHANNEL}, {inbox_channel(settings.WORKER_ID)}")
+
+    async def stop(self):
+        await super().stop()
+        if self.pubsub:
+            await self.pubsub.close()
+
+    async def subscribe_rooms(self, rooms: Set[str]):
+        await self.pubsub.subscribe(*[room_channel(room) for room in rooms])
+
+    async def unsubscribe_rooms(self, rooms: Set[str]):
+        await self.pubsub.unsubscribe(*[room_channel(room) for room in rooms])
+
+    async def listen(self):
+        """Listen to Redis pub/sub channels and broadcast to WebSocket clients until the connection fails"""
+        while True:
+            # Poll with a timeout rather than listen(): the pooled connection has a socket
+            # timeout, and each call lets redis-py run its periodic health check
+            message = await self.pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            if message is None:
+                continue
+            if message['type'] == 'message' and message['channel'] == inbox_channel(settings.WORKER_ID):
+                await self.deliver_inbox(message['data'])
+            elif message['type'] == 'message':
+                try:
+                    # Keep the raw text so local fan-out doesn't re-encode it
+                    envelope = MessageEnvelope.from_text(message['data'], time.monotonic())
+                    # Don't re-broadcast messages from the same instance; sibling
+                    # workers already received them over the worker bus
+                    if envelope.data.get('source_instance') != settings.INSTANCE_ID:
+                        observe_propagation(envelope.data)
+                        await manager.broadcast(envelope)
+                        logger.debug(f"Broadcasted message from Redis: {envelope.type}")
+                except ValueError:
+                    logger.error(f"Failed to decode Redis message: {message['data']}")
+                except Exception as e:
+                    logger.error(f"Error processing Redis message: {e}")
+
+    async def send(self, envelope: MessageEnvelope):
+        # Broadcast to local clients and sibling workers first, then publish the same frame for other instances
+        await manager.broadcast(envelope)
+        # Siblings ignore this instance's messages on the room channels; any the worker bus
+        # couldn't reach get the message through their inbox instead
+        for node_id in worker_bus.forward(envelope):
+            await self.send_to_inbox(node_id, dumps({"broadcast": envelope.data}))
+
+        room = envelope.data.get("room")
+        channel = room_channel(room) if room else SYSTEM_CHANNEL
+        try:
+            with redis_timer("publish"):
+                await self.redis.publish(channel, envelope.text)
+            logger.debug(f"Published to Redis channel {channel}: {envelope.type}")
+        except Exception as e:
+            logger.error(f"Failed to publish to Redis: {e}")
+
+    async def send_to_inbox(self, node_id: str, frame: str) -> bool:
+        try:
+            # Nobody subscribed means the node is gone; its registry entries will expire
+            with redis_timer("publish"):
+                return await self.redis.publish(inbox_channel(node_id), frame) > 0
+        except Exception as e:
+            logger.error(f"Failed to publish direct message: {e}")
+            return False
+
+
+class StreamMessageBus(MessageBus):
+    """
+    Durable transport on Redis Streams.
+    Every instance, including the sender, delivers messages from the streams,
+    so each message reaches clients with its stream_id in stream order. The
+    instance keeps its last-read offset per stream in memory and catches up
+    from it after a reconnect. A restarted process has no clients that missed
+    anything, so it starts reading at the current time; clients catch up with
+    ?resume_from= instead. In multi-worker mode each worker reads the streams
+    itself, so the worker bus isn't used.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # stream -> id of the last entry delivered locally
+        self.offsets: Dict[str, str] = {}
+        self.inbox = inbox_stream(settings.WORKER_ID)
+
+    async def connect(self):
+        # Streams need no connection of their own; make sure Redis answers before calling the bus connected
+        await self.redis.ping()
+        if SYSTEM_STREAM in self.offsets:
+            # Reconnecting: the in-memory offsets already say where to catch up from
+            return
+        for stream in (SYSTEM_STREAM, self.inbox):
+            self.offsets[stream] = self._now_id()
+            logger.info(f"Reading Redis stream: {stream} from {self.offsets[stream]}")
+
+    def _now_id(self) -> str:
+        """A stream id just before anything added from now on"""
+        return f"{int(time.time() * 1000)}-0"
+
+    async def subscribe_rooms(self, rooms: Set[str]):
+        for room in rooms:
+            stream = room_stream(room)
+            # Start at the time of joining; a room still followed keeps its offset
+            self.offsets[stream] = self.offsets.get(stream) or self._now_id()
+
+    async def unsubscribe_rooms(self, rooms: Set[str]):
+        for room in rooms:
+            self.offsets.pop(room_stream(room), None)
+
+    async def listen(self):
+        """Read new stream entries in batches and broadcast them to WebSocket clients until the connection fails"""
+        while True:
+            # Rooms joined while blocked are picked up on the next read, from their join offset
+            response = await self.redis.xread(
+                dict(self.offsets),
+                count=settings.STREAM_READ_COUNT,
+                block=settings.STREAM_BLOCK_MS
+            )
+            if not response:
+                continue
+
+            delivered = {}
+            for stream, entries in response:
+                if stream not in self.offsets:
+                    # The room was left while we were reading
+                    continue
+                for entry_id, fields in entries:
+                    if stream == self.inbox:
+                        await self.deliver_inbox(fields["data"])
+                        delivered[stream] = entry_id
+                        continue
+                    try:
+                        received_at = time.monotonic()
+                        data = loads(fields["data"])
+                        data["stream_id"] = entry_id
+                        observe_propagation(data)
+                        await manager.broadcast(MessageEnvelope(data, received_at=received_at))
+                    except Exception as e:
+                        logger.error(f"Error processing stream entry {entry_id}: {e}")
+                    delivered[stream] = entry_id
+
+            self.offsets.update(delivered)
+
+    async def send(self, envelope: MessageEnvelope):
+        # Local clients get the message from our own stream reader, with its stream id
+        room = envelope.data.get("room")
+        stream = room_stream(room) if room else SYSTEM_STREAM
+        try:
+            with redis_timer("xadd"):
+                await self.redis.xadd(
+                    stream,
+                    {"data": envelope.text},
+                    maxlen=settings.STREAM_MAXLEN,
+                    approximate=True
+                )
+            logger.debug(f"Added to Redis stream {stream}: {envelope.type}")
+        except Exception as e:
+            logger.error(f"Failed to add to Redis stream: {e}")
+
+    async def send_to_inbox(self, node_id: str, frame: str) -> bool:
+        stream = inbox_stream(node_id)
+        try:
+            # Nobody reads the inbox of a node whose task heartbeat has lapsed
+            if not await self.redis.exists(node_key(node_id)):
+                return False
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xadd(stream, {"data": frame}, maxlen=settings.STREAM_MAXLEN, approximate=True)
+                # Inboxes of nodes that are gone for good eventually disappear
+                pipe.expire(stream, settings.STREAM_OFFSET_TTL)
+                await pipe.execute()
+            return True
+        except Exception as e:
+            logger.error(f"Failed to add direct message to Redis stream: {e}")
+            return False
+
+    async def replay(self, room: str, after_id: str, limit: int) -> Optional[List[dict]]:
+        """
+        The entries after after_id, or None if they can't all be replayed: more than limit
+        were missed, or entries after after_id have already been trimmed by MAXLEN
+        """
+        stream = room_stream(room)
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                pipe.xrange(stream, count=1)
+                pipe.xrange(stream, min=f"({after_id}", count=limit + 1)
+                first, entries = await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to replay stream for room {room}: {e}")
+            return None
+        
+        try:
+            trimmed = not first or stream_id(first[0][0]) > stream_id(after_id)
+        except ValueError:
+            return None
+        if trimmed or len(entries) > limit:
+            logger.debug(f"Can't resume room {room} from {after_id}; falling back to history")
+            return None
+
+        messages = []
+        for entry_id, fields in entries:
+            data = loads(fields["data"])
+            data["stream_id"] = entry_id
+            messages.append(data)
+        return messages
+
+
+# Create the global message bus instance for the configured transport
+if settings.BUS_TRANSPORT == "streams":
+    message_bus = StreamMessageBus()
+else:
+    message_bus = PubSubMessageBus()
@@ -2,12 +2,14 @@ from pydantic import BaseModel, Field
 from typing import Optional, List, Dict, Any, Union
 from datetime import datetime
 import time
+from config import settings
 
 class ChatMessage(BaseModel):
     client_id: str
     content: str
     client_ip: Optional[str] = None
     instance_id: Optional[str] = None
+    room: str = "global"
     timestamp: Union[str, float] = Field(default_factory=lambda: time.time())
     type: str = "chat"
     
@@ -29,9 +31,14 @@ class MessageHistoryResponse(BaseModel):
     
 class TaskRequest(BaseModel):
     client_id: str
+    handler: str = "sleep"
+    params: Dict[str, Any] = {}
+    priority: str = settings.TASK_DEFAULT_PRIORITY
 
 class InstanceInfo(BaseModel):
     instance_id: str
     uptime: float
     connection_count: int
-    active_tasks: int
\ No newline at end of file
+    active_tasks: int
+    worker_id: str
+    workers: List[Dict[str, Any]] = []
\ No newline at end of file
@@ -1,33 +1,180 @@
-import json
+import asyncio
 import logging
+import math
 import time
+import uuid
+from collections import OrderedDict
 from datetime import datetime, timedelta
 import redis.asyncio as aioredis  # Use redis.asyncio instead of aioredis
-from typing import Dict, List, Optional, Any
+from typing import AsyncIterator, Dict, Iterable, List, Optional, Any, Tuple
+from prometheus_client import Counter, Histogram
 from config import settings
+from envelope import MessageEnvelope, dumps, loads
 
 logger = logging.getLogger(__name__)
 
+# Number of recently persisted message ids remembered for de-duplication
+RECENT_MESSAGE_IDS = 10000
+
+# Delete a registry entry only if it still belongs to the connection that created it
+UNREGISTER_SCRIPT = """
+if redis.call('HGET', KEYS[1], 'token') == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+# Trim a history sorted set to its ARGV[1] newest members and return the ids it removed
+TRIM_SCRIPT = """
+local removed = redis.call('ZRANGE', KEYS[1], 0, -tonumber(ARGV[1]) - 1)
+if #removed > 0 then
+    redis.call('ZREMRANGEBYRANK', KEYS[1], 0, #removed - 1)
+end
+return removed
+"""
+
+# Delete message bodies (KEYS) whose id is in neither of the history sets that could hold it.
+# ARGV holds an (id, room key, user key) triple per body.
+RELEASE_SCRIPT = """
+local released = 0
+for i = 1, #KEYS do
+    local message_id, room_key, user_key = ARGV[i * 3 - 2], ARGV[i * 3 - 1], ARGV[i * 3]
+    if not redis.call('ZSCORE', room_key, message_id) and not redis.call('ZSCORE', user_key, message_id) then
+        released = released + redis.call('DEL', KEYS[i])
+    end
+end
+return released
+"""
+
+# Track how many chat messages this instance writes to Redis
+redis_message_writes = Counter(
+    "redis_message_writes_total",
+    "Number of chat messages written to Redis history",
+    ["instance_id"]
+)
+# Latency of the Redis calls on the message and history paths
+redis_command_latency = Histogram(
+    "redis_command_seconds",
+    "Latency of Redis calls by command (store_message is the pipeline writing a batch of messages)",
+    ["instance_id", "command"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+)
+
+
+def redis_timer(command: str):
+    """Context manager timing one Redis call into redis_command_seconds"""
+    return redis_command_latency.labels(instance_id=settings.INSTANCE_ID, command=command).time()
+
+
+def parse_cursor(cursor: Optional[str]) -> Tuple[Optional[float], int]:
+    """
+    Split a history cursor "<score>:<skip>" into the score to continue from and the
+    number of members with exactly that score already returned. No cursor (None)
+    means "start at the end". Raises ValueError for a malformed cursor.
+    """
+    if cursor is None or cursor == "":
+        return None, 0
+    if not isinstance(cursor, str):
+        raise ValueError(f"Invalid history cursor: {cursor!r}")
+    score, _, skip = cursor.partition(":")
+    score, skip = float(score), int(skip or 0)
+    if skip < 0 or score != score:
+        raise ValueError(f"Invalid history cursor: {cursor}")
+    return score, skip
+
+
+def next_cursor(scores: List[float], cursor: Optional[str] = None) -> str:
+    """
+    Cursor for the page after one whose members had these scores, in page order.
+    Members sharing the last score are counted so that a tie spanning two pages
+    neither repeats nor skips messages.
+    """
+    last = scores[-1]
+    skip = 0
+    for score in reversed(scores):
+        if score != last:
+            break
+        skip += 1
+    if skip == len(scores):
+        # The whole page had one score; if it is the cursor's, the earlier skip still applies
+        previous_score, previous_skip = parse_cursor(cursor)
+        if previous_score == last:
+            skip += previous_skip
+    return f"{last!r}:{skip}"
+
+
+class WaitingConnectionPool(aioredis.ConnectionPool):
+    """
+    A plain pool whose callers wait for a free connection once max_connections
+    are in use, instead of failing with "Too many connections". redis-py 5.0.1's
+    BlockingConnectionPool deadlocks when a connection attempt fails while
+    Redis is unreachable, so the waiting is done with a semaphore here.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.slots = asyncio.Semaphore(self.max_connections)
+
+    async def get_connection(self, command_name, *keys, **options):
+        await self.slots.acquire()
+        # A connection that fails to connect is handed back through release(), which frees its slot
+        return await super().get_connection(command_name, *keys, **options)
+
+    async def release(self, connection):
+        try:
+            await super().release(connection)
+        finally:
+            self.slots.release()
+
+
 class RedisService:
     def __init__(self):
+        self.pool = None
         self.redis = None
         self.connection_initialized = False
+        self.pending_messages: List[Tuple[MessageEnvelope, Optional[str]]] = []
+        self.pending_event = asyncio.Event()
+        self.batch_full_event = asyncio.Event()
+        self.recent_message_ids: OrderedDict = OrderedDict()
+        self.writer_task = None
+        self.closing = False
+        self.unregister_script = None
+        self.trim_script = None
+        self.release_script = None
     
     async def initialize(self):
+        """
+        Create the shared connection pool. Called once at startup; the other
+        methods assume it has run instead of checking on every call.
+        """
         if not self.connection_initialized:
             try:
-                self.redis = await aioredis.from_url(
+                # Bursts beyond REDIS_MAX_CONNECTIONS wait for a connection rather than fail
+                self.pool = WaitingConnectionPool.from_url(
                     settings.REDIS_URL,
                     password=settings.REDIS_PASSWORD,
+                    max_connections=settings.REDIS_MAX_CONNECTIONS,
+                    socket_timeout=settings.REDIS_SOCKET_TIMEOUT,
+                    socket_connect_timeout=settings.REDIS_SOCKET_CONNECT_TIMEOUT,
+                    socket_keepalive=settings.REDIS_SOCKET_KEEPALIVE,
+                    health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL,
                     encoding="utf-8",
                     decode_responses=True
                 )
+                self.redis = aioredis.Redis(connection_pool=self.pool)
+                self.unregister_script = self.redis.register_script(UNREGISTER_SCRIPT)
+                self.trim_script = self.redis.register_script(TRIM_SCRIPT)
+                self.release_script = self.redis.register_script(RELEASE_SCRIPT)
                 self.connection_initialized = True
                 logger.info(f"Connected to Redis at {settings.REDIS_HOST}")
             except Exception as e:
                 logger.error(f"Failed to connect to Redis: {str(e)}")
                 raise
     
+    def pubsub(self):
+        """A pub/sub object; it holds its own dedicated connection from the shared pool"""
+        return self.redis.pubsub()
+    
     def get_user_id(self, client_id: str, client_ip: str) -> str:
         """
         Generate a unique user identifier from client ID and IP
@@ -35,96 +182,280 @@ class RedisService:
         """
         return f"{client_ip}_{client_id}"
     
-    async def store_message(self, message: Dict[str, Any], user_id: str) -> bool:
+    def room_key(self, room: Optional[str]) -> str:
+        """
+        Sorted set holding a room's history
+        The default room keeps the original messages:global key
+        """
+        if not room or room == settings.DEFAULT_ROOM:
+            return "messages:global"
+        return f"messages:room:{room}"
+    
+    def registry_key(self, client_id: str) -> str:
+        """Key of a client's entry in the cluster-wide connection registry"""
+        return f"registry:client:{client_id}"
+    
+    def user_key(self, user_id: str) -> str:
+        """Sorted set holding the history of messages a user sent"""
+        return f"user:{user_id}:messages"
+    
+    def message_key(self, message_id: str) -> str:
+        """String key holding a message body; history sorted sets only hold the ids"""
+        return f"message:{message_id}"
+    
+    def persist_message(self, envelope: MessageEnvelope, user_id: Optional[str] = None) -> bool:
         """
-        Store a message in Redis for a specific user
-        Messages are stored in a sorted set with timestamp as score for chronological access
+        Queue a chat message for storage in its room's history and, if given, the user's history.
+        Only the instance where the message originated should call this. Messages are
+        de-duplicated by message_id and written in batches by the background writer,
+        at most MESSAGE_FLUSH_INTERVAL_MS after they were queued.
         """
-        await self.initialize()
+        message_id = envelope.data.get("message_id")
+        if message_id:
+            if message_id in self.recent_message_ids:
+                return False
+            self.recent_message_ids[message_id] = None
+            if len(self.recent_message_ids) > RECENT_MESSAGE_IDS:
+                self.recent_message_ids.popitem(last=False)
         
-        try:
-            # Add timestamp if not present
-            if "timestamp" not in message:
-                message["timestamp"] = time.time()
-            
-            # Serialize the message
-            message_str = json.dumps(message)
-            
-            # Get a pipeline for atomic operations
-            pipeline = self.redis.pipeline()
+        self.pending_messages.append((envelope, user_id))
+        self.pending_event.set()
+        if len(self.pending_messages) >= settings.MESSAGE_FLUSH_MAX_BATCH:
+            self.batch_full_event.set()
+        return True
+    
+    def start_message_writer(self):
+        """Start the background task that writes queued messages to Redis"""
+        if self.writer_task is None or self.writer_task.done():
+            self.writer_task = asyncio.create_task(self._message_writer())
+    
+    async def _message_writer(self):
+        interval = settings.MESSAGE_FLUSH_INTERVAL_MS / 1000
+        while not self.closing:
+            await self.pending_event.wait()
             
-            # Add the message to the user's message list (sorted set)
-            user_key = f"user:{user_id}:messages"
+            # Let more writes join this batch, but never hold the first one longer than the interval
+            if len(self.pending_messages) < settings.MESSAGE_FLUSH_MAX_BATCH:
+                self.batch_full_event.clear()
+                try:
+                    await asyncio.wait_for(self.batch_full_event.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
             
-            # Store the message itself using the timestamp as score
-            pipeline.zadd(user_key, {message_str: float(message["timestamp"])})
+            await self.flush_messages()
+    
+    async def flush_messages(self):
+        """Write out every pending message, in pipelines of at most MESSAGE_FLUSH_MAX_BATCH"""
+        while self.pending_messages:
+            batch = self.pending_messages[:settings.MESSAGE_FLUSH_MAX_BATCH]
+            self.pending_messages = self.pending_messages[settings.MESSAGE_FLUSH_MAX_BATCH:]
+            await self.store_messages(batch)
+        self.pending_event.clear()
+    
+    async def close(self):
+        """Stop the background writer, flush anything still pending and close the connection"""
+        self.closing = True
+        if self.writer_task is not None:
+            # Wake the writer so it finishes its current flush and exits
+            self.pending_event.set()
+            self.batch_full_event.set()
+            try:
+                await asyncio.wait_for(self.writer_task, 5)
+            except Exception as e:
+                logger.error(f"Message writer did not stop cleanly: {str(e)}")
+        
+        await self.flush_messages()
+        
+        if self.redis is not None:
+            await self.redis.close()
+            await self.pool.disconnect()
+    
+    async def store_messages(self, batch: List[Tuple[MessageEnvelope, Optional[str]]]) -> bool:
+        """
+        Store a batch of messages in Redis with a single pipeline
+        Message ids are stored in sorted sets with timestamp as score for chronological access,
+        and each body is stored once under message:{id} with the retention period as TTL.
+        Bodies of messages trimmed out of every history set are deleted (see release_bodies),
+        so memory stays bounded by the history caps rather than by message rate.
+        """
+        try:
+            retention = int(timedelta(days=settings.MESSAGE_RETENTION_DAYS).total_seconds())
+            # Get a pipeline for the whole batch
+            pipeline = self.redis.pipeline(transaction=False)
             
-            # Set expiration on the key if it doesn't exist
-            pipeline.expire(user_key, timedelta(days=settings.MESSAGE_RETENTION_DAYS).total_seconds())
+            # Sorted-set key -> number of messages to keep
+            touched_keys = {}
             
-            # Trim to max message count if needed
-            pipeline.zremrangebyrank(user_key, 0, -settings.MAX_MESSAGES_PER_USER-1)
+            stored = 0
+            for envelope, user_id in batch:
+                message_id = envelope.data.get("message_id") or uuid.uuid4().hex
+                try:
+                    score = float(envelope.data.get("timestamp", time.time()))
+                    if not math.isfinite(score):
+                        raise ValueError(f"timestamp {score}")
+                    # Reuse the encoded form shared with the WebSocket and pub/sub paths
+                    body = envelope.text
+                except Exception as e:
+                    # One malformed message must not cost the rest of the batch its history
+                    logger.error(f"Skipping message {message_id} that can't be stored: {str(e)}")
+                    continue
+                stored += 1
+                
+                pipeline.set(self.message_key(message_id), body, ex=retention)
+                
+                # Add the id to its room's history exactly once
+                room_key = self.room_key(envelope.data.get("room"))
+                pipeline.zadd(room_key, {message_id: score})
+                touched_keys[room_key] = settings.MAX_MESSAGES_PER_ROOM
+                
+                if user_id:
+                    # Also add it to the sender's message list (sorted set)
+                    user_key = self.user_key(user_id)
+                    pipeline.zadd(user_key, {message_id: score})
+                    touched_keys[user_key] = settings.MAX_MESSAGES_PER_USER
             
-            # Also add to the global message history
-            global_key = "messages:global"
-            pipeline.zadd(global_key, {message_str: float(message["timestamp"])})
-            pipeline.expire(global_key, timedelta(days=settings.MESSAGE_RETENTION_DAYS).total_seconds())
-            pipeline.zremrangebyrank(global_key, 0, -10000)  # Keep the last 10000 messages globally
+            # Refresh the expiration and trim to the max message count once per key, not per message
+            trims = []
+            for key, max_messages in touched_keys.items():
+                pipeline.expire(key, retention)
+                trims.append(len(pipeline))
+                await self.trim_script(keys=[key], args=[max_messages], client=pipeline)
             
             # Execute all commands
-            await pipeline.execute()
+            with redis_timer("store_message"):
+                results = await pipeline.execute()
             
-            return True
+            redis_message_writes.labels(instance_id=settings.INSTANCE_ID).inc(stored)
         except Exception as e:
-            logger.error(f"Failed to store message: {str(e)}")
+            logger.error(f"Failed to store {len(batch)} messages: {str(e)}")
             return False
+        
+        trimmed = {message_id for index in trims for message_id in results[index]}
+        if trimmed:
+            await self.release_bodies(trimmed)
+        return True
     
-    async def get_user_messages(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    async def release_bodies(self, ids: Iterable[str]):
         """
-        Retrieve the most recent messages for a specific user
+        Delete the bodies of ids trimmed from a history set, unless the other set
+        that references the message (its room's or its sender's) still holds it.
+        The body names both: the room, and the client id and IP the sender's user id is made of.
         """
-        await self.initialize()
-        
+        ids = [message_id for message_id in ids if not message_id.startswith("{")]
         try:
-            user_key = f"user:{user_id}:messages"
-            
-            # Get messages from newest to oldest (reverse chronological order)
-            message_data = await self.redis.zrevrange(user_key, 0, limit - 1)
-            
-            # Parse JSON strings back to dictionaries
-            messages = [json.loads(msg) for msg in message_data]
-            
-            return messages
+            keys = [self.message_key(message_id) for message_id in ids]
+            bodies = await self.redis.mget(keys)
+            release_keys, release_args = [], []
+            for message_id, key, body in zip(ids, keys, bodies):
+                if body is None:
+                    continue
+                data = loads(body)
+                user_id = self.get_user_id(data.get("client_id"), data.get("client_ip") or "unknown")
+                release_keys.append(key)
+                release_args += [message_id, self.room_key(data.get("room")), self.user_key(user_id)]
+            if release_keys:
+                await self.release_script(keys=release_keys, args=release_args)
         except Exception as e:
-            logger.error(f"Failed to get user messages: {str(e)}")
-            return []
+            # The bodies still expire with the retention TTL
+            logger.error(f"Failed to release {len(ids)} trimmed message bodies: {str(e)}")
     
-    async def get_recent_messages(self, limit: int = 50) -> List[Dict[str, Any]]:
+    async def load_bodies(self, ids: List[str]) -> List[str]:
         """
-        Retrieve the most recent global messages
+        Fetch the JSON bodies for a list of history ids with a single MGET
+        Bodies that have expired are skipped
         """
-        await self.initialize()
+        if not ids:
+            return []
+        
+        # Sets written before id-keyed storage hold the JSON itself as the member
+        keys = [self.message_key(message_id) for message_id in ids if not message_id.startswith("{")]
+        if keys:
+            with redis_timer("mget"):
+                bodies = iter(await self.redis.mget(keys))
+        else:
+            bodies = iter(())
         
+        loaded = []
+        for message_id in ids:
+            body = message_id if message_id.startswith("{") else next(bodies)
+            if body is not None:
+                loaded.append(body)
+        return loaded
+    
+    async def load_messages(self, ids: List[str]) -> List[Dict[str, Any]]:
+        """Fetch and parse the messages for a list of history ids"""
+        return [loads(body) for body in await self.load_bodies(ids)]
+    
+    async def read_page(self, key: str, limit: int, cursor: Optional[str], oldest_first: bool = False) -> List[Tuple[str, float]]:
+        """
+        Up to limit (id, score) pairs of a history sorted set, newest first unless oldest_first,
+        starting at a cursor. Z(REV)RANGEBYSCORE with LIMIT only touches the members it returns,
+        however deep the page is, and unlike rank offsets is not thrown off by concurrent writes.
+        """
+        score, skip = parse_cursor(cursor)
+        if oldest_first:
+            with redis_timer("zrangebyscore"):
+                return await self.redis.zrangebyscore(
+                    key, "-inf" if score is None else score, "+inf", start=skip, num=limit, withscores=True
+                )
+        with redis_timer("zrevrangebyscore"):
+            return await self.redis.zrevrangebyscore(
+                key, "+inf" if score is None else score, "-inf", start=skip, num=limit, withscores=True
+            )
+    
+    async def get_history_page(self, key: str, limit: int, cursor: Optional[str] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        One page of a history sorted set, newest first, and the cursor of the next page
+        (None when there are no older messages). Raises ValueError for a malformed cursor.
+        """
+        parse_cursor(cursor)
         try:
-            global_key = "messages:global"
-            
-            # Get messages from newest to oldest
-            message_data = await self.redis.zrevrange(global_key, 0, limit - 1)
-            
-            # Parse JSON strings back to dictionaries
-            messages = [json.loads(msg) for msg in message_data]
-            
-            return messages
+            entries = await self.read_page(key, limit, cursor)
+            messages = await self.load_messages([message_id for message_id, _ in entries])
         except Exception as e:
-            logger.error(f"Failed to get recent messages: {str(e)}")
-            return []
+            logger.error(f"Failed to get history page of {key}: {str(e)}")
+            return [], None
+        
+        # A short page means we reached the oldest message
+        if len(entries) < limit:
+            return messages, None
+        return messages, next_cursor([score for _, score in entries], cursor)
+    
+    async def iter_history(self, key: str, cursor: Optional[str] = None, oldest_first: bool = False) -> AsyncIterator[List[str]]:
+        """
+        Yield the JSON bodies of a history sorted set in chunks, newest first unless oldest_first,
+        starting at a cursor. Redis is read HISTORY_STREAM_CHUNK ids at a time, so only one chunk
+        is held in memory however long the history is. Raises ValueError for a malformed cursor.
+        """
+        parse_cursor(cursor)
+        chunk = settings.HISTORY_STREAM_CHUNK
+        while True:
+            entries = await self.read_page(key, chunk, cursor, oldest_first)
+            bodies = await self.load_bodies([message_id for message_id, _ in entries])
+            if bodies:
+                yield bodies
+            if len(entries) < chunk:
+                return
+            cursor = next_cursor([score for _, score in entries], cursor)
+    
+    async def get_user_messages(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """
+        Retrieve the most recent messages for a specific user
+        """
+        messages, _ = await self.get_history_page(self.user_key(user_id), limit)
+        return messages
+    
+    async def get_recent_messages(self, limit: int = 50, room: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Retrieve the most recent messages of a room (the global room by default)
+        """
+        messages, _ = await self.get_history_page(self.room_key(room), limit)
+        return messages
     
     async def store_user_connection(self, user_id: str, client_id: str, ip_address: str) -> None:
         """
         Track user connection information
         """
-        await self.initialize()
-        
         try:
             user_connection_key = f"user:{user_id}:connections"
             connection_data = {
@@ -134,10 +465,50 @@ class RedisService:
                 "instance_id": settings.INSTANCE_ID
             }
             
-            await self.redis.hset(user_connection_key, client_id, json.dumps(connection_data))
-            await self.redis.expire(user_connection_key, timedelta(days=1).total_seconds())
+            await self.redis.hset(user_connection_key, client_id, dumps(connection_data))
+            await self.redis.expire(user_connection_key, int(timedelta(days=1).total_seconds()))
         except Exception as e:
             logger.error(f"Failed to store user connection: {str(e)}")
 
+    async def register_connection(self, client_id: str, token: str) -> None:
+        """
+        Record that this node (settings.WORKER_ID) holds the client's connection.
+        The token identifies the connection so a stale disconnect can't remove a newer entry.
+        """
+        try:
+            key = self.registry_key(client_id)
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.hset(key, mapping={"node": settings.WORKER_ID, "token": token})
+                pipe.expire(key, settings.CONNECTION_REGISTRY_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to register connection: {str(e)}")
+    
+    async def unregister_connection(self, client_id: str, token: str) -> None:
+        """Remove the client's registry entry if it still belongs to the connection with this token"""
+        try:
+            await self.unregister_script(keys=[self.registry_key(client_id)], args=[token])
+        except Exception as e:
+            logger.error(f"Failed to unregister connection: {str(e)}")
+    
+    async def refresh_connections(self, client_ids: List[str]) -> None:
+        """Push back the expiry of the registry entries of connections that are still alive"""
+        try:
+            async with self.redis.pipeline(transaction=False) as pipe:
+                for client_id in client_ids:
+                    pipe.expire(self.registry_key(client_id), settings.CONNECTION_REGISTRY_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.error(f"Failed to refresh connections: {str(e)}")
+    
+    async def lookup_connection(self, client_id: str) -> Optional[str]:
+        """The node currently holding the client's connection, if any"""
+        try:
+            return await self.redis.hget(self.registry_key(client_id), "node")
+        except Exception as e:
+            logger.error(f"Failed to look up connection: {str(e)}")
+            return None
+
 # Create a global redis service instance
 redis_service = RedisService()
@@ -0,0 +1,166 @@
+// Minimal MessagePack codec for the "msgpack" WebSocket subprotocol.
+// Covers the types the chat protocol uses: nil, booleans, integers, floats,
+// strings, binary, arrays and maps. 64-bit integers decode to Numbers.
+const MsgPack = (() => {
+    const textEncoder = new TextEncoder();
+    const textDecoder = new TextDecoder();
+
+    function encode(value) {
+        const bytes = [];
+        write(value, bytes);
+        return new Uint8Array(bytes);
+    }
+
+    function pushUint(bytes, value, size) {
+        for (let shift = (size - 1) * 8; shift >= 0; shift -= 8) {
+            bytes.push(Math.floor(value / 2 ** shift) & 0xff);
+        }
+    }
+
+    function pushFloat64(bytes, value) {
+        const view = new DataView(new ArrayBuffer(8));
+        view.setFloat64(0, value);
+        bytes.push(0xcb, ...new Uint8Array(view.buffer));
+    }
+
+    function writeLength(bytes, length, fixBase, fixMax, codes) {
+        if (fixBase !== null && length <= fixMax) {
+            bytes.push(fixBase | length);
+        } else if (codes[0] !== null && length < 0x100) {
+            bytes.push(codes[0], length);
+        } else if (length < 0x10000) {
+            bytes.push(codes[1]);
+            pushUint(bytes, length, 2);
+        } else {
+            bytes.push(codes[2]);
+            pushUint(bytes, length, 4);
+        }
+    }
+
+    function write(value, bytes) {
+        if (value === null || value === undefined) {
+            bytes.push(0xc0);
+        } else if (value === false) {
+            bytes.push(0xc2);
+        } else if (value === true) {
+            bytes.push(0xc3);
+        } else if (typeof value === 'number') {
+            if (!Number.isSafeInteger(value)) {
+                pushFloat64(bytes, value);
+            } else if (value >= 0) {
+                if (value < 0x80) bytes.push(value);
+                else if (value < 0x100) bytes.push(0xcc, value);
+                else if (value < 0x10000) { bytes.push(0xcd); pushUint(bytes, value, 2); }
+                else if (value < 0x100000000) { bytes.push(0xce); pushUint(bytes, value, 4); }
+                else { bytes.push(0xcf); pushUint(bytes, value, 8); }
+            } else if (value >= -32) {
+                bytes.push(value & 0xff);
+            } else if (value >= -0x80000000) {
+                bytes.push(0xd2);
+                pushUint(bytes, value >>> 0, 4);
+            } else {
+                pushFloat64(bytes, value);
+            }
+        } else if (typeof value === 'string') {
+            const encoded = textEncoder.encode(value);
+            writeLength(bytes, encoded.length, 0xa0, 31, [0xd9, 0xda, 0xdb]);
+            for (const b of encoded) bytes.push(b);
+        } else if (value instanceof Uint8Array) {
+            writeLength(bytes, value.length, null, 0, [0xc4, 0xc5, 0xc6]);
+            for (const b of value) bytes.push(b);
+        } else if (Array.isArray(value)) {
+            writeLength(bytes, value.length, 0x90, 15, [null, 0xdc, 0xdd]);
+            value.forEach(item => write(item, bytes));
+        } else if (typeof value === 'object') {
+            const keys = Object.keys(value).filter(key => value[key] !== undefined);
+            writeLength(bytes, keys.length, 0x80, 15, [null, 0xde, 0xdf]);
+            keys.forEach(key => {
+                write(key, bytes);
+                write(value[key], bytes);
+            });
+        } else {
+            throw new Error(`Cannot encode ${typeof value} as MessagePack`);
+        }
+    }
+
+    function decode(buffer) {
+        const bytes = buffer instanceof Uint8Array ? buffer : new Uint8Array(buffer);
+        const view = new DataView(bytes.buffer, bytes.byteOffset, bytes.byteLength);
+        let offset = 0;
+
+        function uint(size) {
+            let value = 0;
+            for (let i = 0; i < size; i++) value = value * 256 + bytes[offset + i];
+            offset += size;
+            return value;
+        }
+
+        function str(length) {
+            const value = textDecoder.decode(bytes.subarray(offset, offset + length));
+            offset += length;
+            return value;
+        }
+
+        function bin(length) {
+            const value = bytes.slice(offset, offset + length);
+            offset += length;
+            return value;
+        }
+
+        function array(length) {
+            const value = [];
+            for (let i = 0; i < length; i++) value.push(read());
+            return value;
+        }
+
+        function map(length) {
+            const value = {};
+            for (let i = 0; i < length; i++) {
+                const key = read();
+                value[key] = read();
+            }
+            return value;
+        }
+
+        function read() {
+            const code = bytes[offset++];
+            if (code < 0x80) return code;
+            if (code < 0x90) return map(code & 0x0f);
+            if (code < 0xa0) return array(code & 0x0f);
+            if (code < 0xc0) return str(code & 0x1f);
+            if (code >= 0xe0) return code - 0x100;
+
+            let value;
+            switch (code) {
+                case 0xc0: return null;
+                case 0xc2: return false;
+                case 0xc3: return true;
+                case 0xc4: return bin(uint(1));
+                case 0xc5: return bin(uint(2));
+                case 0xc6: return bin(uint(4));
+                case 0xca: value = view.getFloat32(offset); offset += 4; return value;
+                case 0xcb: value = view.getFloat64(offset); offset += 8; return value;
+                case 0xcc: return uint(1);
+                case 0xcd: return uint(2);
+                case 0xce: return uint(4);
+                case 0xcf: return uint(8);
+                case 0xd0: value = view.getInt8(offset); offset += 1; return value;
+                case 0xd1: value = view.getInt16(offset); offset += 2; return value;
+                case 0xd2: value = view.getInt32(offset); offset += 4; return value;
+                case 0xd3: value = Number(view.getBigInt64(offset)); offset += 8; return value;
+                case 0xd9: return str(uint(1));
+                case 0xda: return str(uint(2));
+                case 0xdb: return str(uint(4));
+                case 0xdc: return array(uint(2));
+                case 0xdd: return array(uint(4));
+                case 0xde: return map(uint(2));
+                case 0xdf: return map(uint(4));
+                default: throw new Error(`Unsupported MessagePack type 0x${code.toString(16)}`);
+            }
+        }
+
+        return read();
+    }
+
+    return { encode, decode };
+})();
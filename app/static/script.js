@@ -8,7 +8,15 @@ let messagesReceived = 0;
 let tasksCreated = 0;
 let tasksCompleted = 0;
 let reconnectAttempts = 0;
+// Last stream id seen in the global room, used to resume after a reconnect (streams transport only)
+let lastStreamId = null;
+// Server-provided delay (ms) before the next reconnect when it turned us away
+let retryAfterMs = null;
+// Cursor of the next (older) page of our own history; "Load History" pages back from the newest
+let historyCursor = null;
 const maxReconnectAttempts = 5;
+// Open the page with ?codec=msgpack to use the binary MessagePack subprotocol instead of JSON
+const useMsgpack = new URLSearchParams(window.location.search).get('codec') === 'msgpack';
 
 // DOM elements
 const statusIconElement = document.getElementById('status');
@@ -57,10 +65,13 @@ function connectWebSocket() {
     clientId = getClientId();
     console.log('Connecting with client ID:', clientId); // Debug log
     const protocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-    const wsUrl = `${protocol}//${window.location.host}/ws/${clientId}`;
+    const resumeQuery = lastStreamId ? `?resume_from=${encodeURIComponent(lastStreamId)}` : '';
+    const wsUrl = `${protocol}//${window.location.host}/ws/${clientId}${resumeQuery}`;
     console.log('WebSocket URL:', wsUrl); // Debug log
     
-    socket = new WebSocket(wsUrl);
+    // The server picks msgpack only if it supports it; socket.protocol says what we got
+    socket = useMsgpack ? new WebSocket(wsUrl, ['msgpack']) : new WebSocket(wsUrl);
+    socket.binaryType = 'arraybuffer';
     
     socket.onopen = () => {
         console.log('WebSocket connection established');
@@ -71,21 +82,28 @@ function connectWebSocket() {
     
     socket.onmessage = (event) => {
         console.log('Received message:', event.data); // Debug log
-        const data = JSON.parse(event.data);
+        const data = typeof event.data === 'string' ? JSON.parse(event.data) : MsgPack.decode(event.data);
         handleWebSocketMessage(data);
     };
     
     socket.onclose = (event) => {
         console.log('WebSocket connection closed', event);
+        // Read before setConnectionStatus clears it; false after a manual disconnect
+        const wasConnected = isConnected;
         setConnectionStatus('disconnected');
         disableInterface();
         
-        // Auto-reconnect logic (if not manually disconnected)
-        if (isConnected && reconnectAttempts < maxReconnectAttempts) {
+        // Auto-reconnect logic (if not manually disconnected, or if the server asked us to retry)
+        const retryRequested = retryAfterMs !== null;
+        if ((wasConnected || retryRequested) && reconnectAttempts < maxReconnectAttempts) {
             reconnectAttempts++;
-            const delay = Math.min(1000 * reconnectAttempts, 5000);
+            // Honour the server's retry-after hint, otherwise back off with jitter
+            const delay = retryRequested
+                ? retryAfterMs
+                : Math.min(1000 * reconnectAttempts, 5000) * (0.5 + Math.random() / 2);
+            retryAfterMs = null;
             
-            addSystemMessage(`Connection lost. Attempting to reconnect in ${delay/1000} seconds...`);
+            addSystemMessage(`Connection lost. Attempting to reconnect in ${(delay/1000).toFixed(1)} seconds...`);
             
             setTimeout(() => {
                 addSystemMessage(`Reconnecting... (Attempt ${reconnectAttempts}/${maxReconnectAttempts})`);
@@ -118,6 +136,7 @@ function handleWebSocketMessage(data) {
             break;
             
         case 'chat':
+            trackStreamId(data);
             addChatMessage(data);
             highlightInstanceChange(data.instance_id);
             break;
@@ -131,6 +150,12 @@ function handleWebSocketMessage(data) {
             // Display chat history
             const historySource = data.source || 'unknown';
             addSystemMessage(`Loaded ${data.messages.length} messages from ${historySource}`);
+            if (historySource === 'user_history') {
+                historyCursor = data.next_cursor || null;
+                if (!historyCursor) {
+                    addSystemMessage('No older messages');
+                }
+            }
             
             // Clear chat if there are messages
             if (data.messages && data.messages.length > 0) {
@@ -139,6 +164,7 @@ function handleWebSocketMessage(data) {
                 
                 // Add each message to the UI (in chronological order)
                 chatMessages.forEach(msg => {
+                    trackStreamId(msg);
                     addChatMessage(msg);
                 });
                 
@@ -146,12 +172,55 @@ function handleWebSocketMessage(data) {
             }
             break;
             
+        case 'direct_message':
+            if (data.client_id === clientId && !data.delivered) {
+                addSystemMessage(`${escapeHtml(data.target_client_id)} is not connected`);
+            } else {
+                addChatMessage({...data, content: `(private) ${data.content}`});
+            }
+            break;
+            
+        case 'ping':
+            // Heartbeat from the server; answer so it knows we are still here
+            sendToServer({type: 'pong', ts: data.ts});
+            break;
+            
+        case 'resync':
+            // We fell too far behind and the server dropped the backlog; reload recent chat
+            addSystemMessage(`Connection fell behind, ${data.skipped} messages skipped. Reloading chat history`);
+            if (socket && socket.readyState === WebSocket.OPEN) {
+                sendToServer({type: 'get_history', limit: 50, history_type: 'chat'});
+            }
+            break;
+            
+        case 'retry_after':
+            // The server is busy; reconnect after the suggested delay
+            retryAfterMs = data.retry_after * 1000;
+            addSystemMessage(`Server busy, retrying in ${data.retry_after} seconds`);
+            break;
+            
+        case 'room_joined':
+            addSystemMessage(`Joined room ${data.room}`);
+            break;
+            
+        case 'room_left':
+            addSystemMessage(`Left room ${data.room}`);
+            break;
+            
         case 'task_created':
             tasksCreated++;
             updateMetrics();
             addTaskToUI(data.task_id, data.details);
             break;
             
+        case 'task_rejected':
+            addSystemMessage(`Task not started: ${escapeHtml(data.reason)}`);
+            break;
+            
+        case 'task_progress':
+            updateTaskProgress(data.task_id, data);
+            break;
+            
         case 'task_completed':
             tasksCompleted++;
             updateMetrics();
@@ -164,6 +233,27 @@ function handleWebSocketMessage(data) {
     }
 }
 
+// Send a message object in the format negotiated for this connection
+function sendToServer(message) {
+    socket.send(socket.protocol === 'msgpack' ? MsgPack.encode(message) : JSON.stringify(message));
+}
+
+// Remember the newest global stream id seen; history arrives newest-first, so keep the maximum
+function trackStreamId(message) {
+    if (message.stream_id && (!message.room || message.room === 'global')) {
+        if (!lastStreamId || compareStreamIds(message.stream_id, lastStreamId) > 0) {
+            lastStreamId = message.stream_id;
+        }
+    }
+}
+
+// Compare two "<ms>-<seq>" stream ids in stream order
+function compareStreamIds(a, b) {
+    const [aMs, aSeq] = a.split('-').map(Number);
+    const [bMs, bSeq] = b.split('-').map(Number);
+    return aMs !== bMs ? aMs - bMs : (aSeq || 0) - (bSeq || 0);
+}
+
 // UI Helper functions
 function setConnectionStatus(status) {
     statusIconElement.className = `status-icon ${status}`;
@@ -244,7 +334,13 @@ function highlightInstanceChange(newInstanceId) {
     }
 }
 
+function taskDuration(details) {
+    // Only the sleeping demo handlers have a known duration
+    return (details.params && details.params.duration) || null;
+}
+
 function addTaskToUI(taskId, details) {
+    const duration = taskDuration(details);
     const taskElement = document.createElement('div');
     taskElement.className = 'task running';
     taskElement.id = `task-${taskId}`;
@@ -254,24 +350,33 @@ function addTaskToUI(taskId, details) {
             <span class="task-status">Running</span>
         </div>
         <div class="task-details">
-            <div>Duration: ${details.duration}s</div>
+            <div>Task: ${escapeHtml(details.handler)}${duration ? ` (${duration}s)` : ''}</div>
             <div>Instance: ${details.instance_id}</div>
             <div class="task-progress">
                 <div class="progress-bar"></div>
             </div>
+            <div class="task-progress-text">Queued</div>
         </div>
     `;
+    taskElement.dataset.partials = '0';
     
     tasksElement.appendChild(taskElement);
+}
+
+function updateTaskProgress(taskId, data) {
+    const taskElement = document.getElementById(`task-${taskId}`);
+    if (!taskElement) return;
     
-    // Animate progress bar
-    const progressBar = taskElement.querySelector('.progress-bar');
-    progressBar.style.transition = `width ${details.duration}s linear`;
+    // Partial results arrive in batches; just count them here
+    const partials = Number(taskElement.dataset.partials) + (data.partials || []).length;
+    taskElement.dataset.partials = String(partials);
     
-    // Small delay to ensure transition works
-    setTimeout(() => {
-        progressBar.style.width = '100%';
-    }, 50);
+    if (data.progress !== null && data.progress !== undefined) {
+        taskElement.querySelector('.progress-bar').style.width = `${data.progress}%`;
+    }
+    const progressText = taskElement.querySelector('.task-progress-text');
+    progressText.textContent = `${data.progress !== null && data.progress !== undefined ? data.progress : '?'}%`
+        + (partials ? `, ${partials} partial results` : '');
 }
 
 function updateTaskInUI(taskId, details) {
@@ -284,13 +389,13 @@ function updateTaskInUI(taskId, details) {
     statusElement.textContent = details.status === 'completed' ? 'Completed' : 'Failed';
     
     const detailsElement = taskElement.querySelector('.task-details');
-    const duration = details.duration || 'unknown';
+    const duration = taskDuration(details);
     const completedTime = details.completed_at 
         ? new Date(details.completed_at).toLocaleTimeString()
         : 'unknown';
     
     detailsElement.innerHTML = `
-        <div>Duration: ${duration}s</div>
+        <div>Task: ${escapeHtml(details.handler)}${duration ? ` (${duration}s)` : ''}</div>
         <div>Instance: ${details.instance_id}</div>
         <div>Completed: ${completedTime}</div>
     `;
@@ -346,8 +451,16 @@ function sendMessage() {
             timestamp: Date.now()
         };
         
-        console.log('Sending JSON:', JSON.stringify(message)); // Debug log
-        socket.send(JSON.stringify(message));
+        // "/msg <client_id> <text>" sends a private message to one client
+        const direct = messageContent.match(/^\/msg\s+(\S+)\s+(.+)$/);
+        if (direct) {
+            message.type = 'direct_message';
+            message.target_client_id = direct[1];
+            message.content = direct[2];
+        }
+        
+        console.log('Sending:', JSON.stringify(message)); // Debug log
+        sendToServer(message);
         messageInputElement.value = '';
         messagesSent++;
         updateMetrics();
@@ -369,9 +482,10 @@ function loadHistory() {
         const message = {
             type: 'get_history',
             limit: 50,
-            history_type: 'user'
+            history_type: 'user',
+            cursor: historyCursor
         };
-        socket.send(JSON.stringify(message));
+        sendToServer(message);
     }
 }
 
@@ -380,7 +494,7 @@ function startBackgroundTask() {
         const message = {
             type: 'task_request'
         };
-        socket.send(JSON.stringify(message));
+        sendToServer(message);
     }
 }
 
@@ -0,0 +1,265 @@
+"""
+Registry of background task handlers.
+
+A handler is declared with @task_handler(name, mode, defaults, schema) and
+called with the task's params as keyword arguments. Clients may only set the
+params named in the schema, each checked for its type and bounds, so a
+request can't make a task run for longer than the server allows. The mode
+says where it runs:
+
+- "async": awaited on the event loop; for handlers that mostly wait on I/O
+- "thread": in a thread pool; for blocking calls that release the GIL
+- "process": in a process pool; for CPU-bound work, which would otherwise
+  hold the GIL (and so the event loop) for as long as it runs
+
+Async handlers may be async generators and thread handlers generators: they
+stream their progress by yielding updates, dicts with any of "progress" (a
+percentage), "partial" (a piece of the result, delivered as it is produced)
+and "result" (the final result). TaskManager passes the updates on to the
+client at a limited rate. A long CPU-bound job streams from an async handler
+that awaits run_in_process for each chunk of work.
+
+Process handlers run in worker processes started with "spawn", so they must
+be module-level functions, their params and results must pickle, and this
+module must not import the application.
+"""
+import asyncio
+import functools
+import hashlib
+import inspect
+import logging
+import multiprocessing
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+HANDLER_MODES = ("async", "thread", "process")
+
+
+class Param:
+    """A param clients may set: an int within [minimum, maximum], or a str of at most maximum characters"""
+    __slots__ = ("kind", "minimum", "maximum")
+
+    def __init__(self, kind: type, minimum: int = 0, maximum: Optional[int] = None):
+        self.kind = kind
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def check(self, name: str, value: Any):
+        """Raise ValueError unless value is acceptable for the param called name"""
+        if not isinstance(value, self.kind) or isinstance(value, bool):
+            raise ValueError(f"Task param {name} must be of type {self.kind.__name__}")
+        if self.kind is str:
+            if self.maximum is not None and len(value) > self.maximum:
+                raise ValueError(f"Task param {name} must be at most {self.maximum} characters")
+        elif value < self.minimum or (self.maximum is not None and value > self.maximum):
+            raise ValueError(f"Task param {name} must be between {self.minimum} and {self.maximum}")
+
+
+class TaskHandler:
+    __slots__ = ("name", "func", "mode", "defaults", "schema")
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable,
+        mode: str,
+        defaults: Optional[Callable[[], Dict[str, Any]]],
+        schema: Dict[str, Param]
+    ):
+        self.name = name
+        self.func = func
+        self.mode = mode
+        self.defaults = defaults
+        self.schema = schema
+
+    def params(self, params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        The params for a new task: the handler's defaults, overridden by the request's.
+        Raises ValueError if the request's params aren't an object of known, valid params.
+        """
+        if params is None:
+            params = {}
+        if not isinstance(params, dict):
+            raise ValueError("Task params must be an object")
+        for name, value in params.items():
+            if name not in self.schema:
+                raise ValueError(f"Unknown param {name} for task handler {self.name}")
+            self.schema[name].check(name, value)
+        merged = self.defaults() if self.defaults else {}
+        merged.update(params)
+        return merged
+
+
+# Handler name -> handler
+handlers: Dict[str, TaskHandler] = {}
+
+# Executors are created on first use, so processes that never run such a handler don't pay for them
+thread_pool = None
+process_pool = None
+
+
+def task_handler(
+    name: str,
+    mode: str = "async",
+    defaults: Optional[Callable[[], Dict[str, Any]]] = None,
+    schema: Optional[Dict[str, Param]] = None
+):
+    """
+    Register a function as the handler of tasks called name; defaults() supplies params
+    a request leaves out, and schema names the params a request may set
+    """
+    if mode not in HANDLER_MODES:
+        raise ValueError(f"Unknown handler mode {mode}, expected one of {HANDLER_MODES}")
+
+    def register(func: Callable) -> Callable:
+        if mode == "process" and inspect.isgeneratorfunction(func):
+            raise ValueError(f"Process handler {name} can't be a generator; stream from an async handler instead")
+        handlers[name] = TaskHandler(name, func, mode, defaults, schema or {})
+        # Return the function itself so process handlers still pickle by reference
+        return func
+    return register
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    global thread_pool
+    if thread_pool is None:
+        thread_pool = ThreadPoolExecutor(max_workers=settings.TASK_THREAD_WORKERS, thread_name_prefix="task")
+        logger.info(f"Started task thread pool with {settings.TASK_THREAD_WORKERS} threads")
+    return thread_pool
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(
+            max_workers=settings.TASK_PROCESS_WORKERS,
+            mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"Started task process pool with {settings.TASK_PROCESS_WORKERS} processes")
+    return process_pool
+
+
+def drain(call: Callable, report: Callable[[Dict[str, Any]], None]) -> Any:
+    """Run a generator handler to the end, reporting each update; returns the last "result" it gave"""
+    result = None
+    for update in call():
+        result = update.get("result", result)
+        report(update)
+    return result
+
+
+async def run_in_process(func: Callable, *args) -> Any:
+    """
+    Run a module-level function in the process pool. Streaming handlers use this
+    to do CPU-bound work in chunks and report progress between them.
+    """
+    global process_pool
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_process_pool(), func, *args)
+    except BrokenProcessPool:
+        # A pool process died (e.g. killed for memory); start a fresh pool for the next task
+        process_pool = None
+        raise
+
+
+async def run_handler(name: str, params: Dict[str, Any], report: Callable[[Dict[str, Any]], None]) -> Any:
+    """
+    Run a task's handler in its lane and return its result without blocking the event loop.
+    Updates from generator handlers are passed to report(update) on the event loop.
+    """
+    handler = handlers[name]
+    if handler.mode == "async":
+        if not inspect.isasyncgenfunction(handler.func):
+            return await handler.func(**params)
+        result = None
+        async for update in handler.func(**params):
+            result = update.get("result", result)
+            report(update)
+        return result
+
+    call = functools.partial(handler.func, **params)
+    if handler.mode == "thread":
+        loop = asyncio.get_running_loop()
+        if inspect.isgeneratorfunction(handler.func):
+            call = functools.partial(drain, call, lambda update: loop.call_soon_threadsafe(report, update))
+        return await loop.run_in_executor(get_thread_pool(), call)
+    return await run_in_process(call)
+
+
+def shutdown_pools():
+    """Stop the executors; tasks still running in them are abandoned (and requeued by TaskManager)"""
+    global thread_pool, process_pool
+    for pool in (thread_pool, process_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    thread_pool = process_pool = None
+
+
+def random_duration() -> Dict[str, Any]:
+    return {"duration": random.randint(settings.MIN_TASK_DELAY, settings.MAX_TASK_DELAY)}
+
+
+# Sleeping tasks may last as long as the server would have picked at most
+SLEEP_SCHEMA = {"duration": Param(int, 0, settings.MAX_TASK_DELAY)}
+
+
+@task_handler("sleep", defaults=random_duration, schema=SLEEP_SCHEMA)
+async def simulate(duration: int):
+    """The demo task: wait for a while, reporting progress every second"""
+    for second in range(1, duration + 1):
+        await asyncio.sleep(1)
+        yield {"progress": round(100 * second / duration, 1)}
+    yield {"result": {"slept": duration}}
+
+
+@task_handler("blocking_sleep", mode="thread", defaults=random_duration, schema=SLEEP_SCHEMA)
+def blocking_sleep(duration: int):
+    """The demo task as blocking calls, the way a synchronous client library would wait"""
+    for second in range(1, duration + 1):
+        time.sleep(1)
+        yield {"progress": round(100 * second / duration, 1)}
+    yield {"result": {"slept": duration}}
+
+
+@task_handler(
+    "hash_chain",
+    mode="process",
+    defaults=lambda: {"rounds": settings.HASH_CHAIN_ROUNDS},
+    schema={"rounds": Param(int, 1, settings.HASH_CHAIN_MAX_ROUNDS), "seed": Param(str, maximum=256)}
+)
+def hash_chain(rounds: int, seed: str = "") -> Dict[str, Any]:
+    """CPU-bound work: hash a value rounds times over"""
+    digest = seed.encode("utf-8")
+    for _ in range(rounds):
+        digest = hashlib.sha256(digest).digest()
+    return {"rounds": rounds, "digest": digest.hex()}
+
+
+def primes_between(start: int, stop: int) -> List[int]:
+    """The primes in [start, stop), by trial division; deliberately CPU-bound"""
+    found = []
+    for n in range(max(start, 2), stop):
+        if all(n % d for d in range(2, int(n ** 0.5) + 1)):
+            found.append(n)
+    return found
+
+
+@task_handler(
+    "primes",
+    defaults=lambda: {"limit": settings.PRIMES_LIMIT},
+    schema={"limit": Param(int, 2, settings.PRIMES_MAX_LIMIT), "chunk": Param(int, 1000, 100000)}
+)
+async def primes(limit: int, chunk: int = 10000):
+    """Find the primes below limit in the process pool, streaming each chunk's primes as they are found"""
+    total = 0
+    for start in range(0, limit, chunk):
+        found = await run_in_process(primes_between, start, min(start + chunk, limit))
+        total += len(found)
+        yield {"progress": round(100 * min(start + chunk, limit) / limit, 1), "partial": found}
+    yield {"result": {"limit": limit, "count": total}}
@@ -1,10 +1,15 @@
 from fastapi import WebSocket
-from typing import Dict, Optional, Any
+from typing import Callable, Dict, List, Optional, Any, Set, Tuple
+from collections import deque
+import asyncio
 import logging
-import json
+import time
+import uuid
 from config import settings
-from prometheus_client import Counter, Gauge
+from prometheus_client import Counter, Gauge, Histogram
 from redis_service import redis_service
+from envelope import MSGPACK_SUBPROTOCOL, MessageEnvelope
+from history_cache import history_cache
 
 # Set up logging
 logger = logging.getLogger(__name__)
@@ -13,104 +18,450 @@ logger = logging.getLogger(__name__)
 websocket_connections = Gauge(
     "websocket_connections_total", 
     "Number of active WebSocket connections",
-    ["instance_id"]
+    ["instance_id"],
+    multiprocess_mode="livesum"
 )
 websocket_messages = Counter(
     "websocket_messages_total", 
     "Number of WebSocket messages processed",
     ["instance_id", "direction"]  # direction: inbound or outbound
 )
+websocket_send_queue_depth = Gauge(
+    "websocket_send_queue_depth",
+    "Number of outbound messages waiting in per-connection send queues",
+    ["instance_id"],
+    multiprocess_mode="livesum"
+)
+websocket_send_queue_drops = Counter(
+    "websocket_send_queue_drops_total",
+    "Number of times a full send queue triggered the overflow policy",
+    ["instance_id", "policy"]  # policy: drop_oldest, drop_newest, coalesce or disconnect
+)
+websocket_evicted_clients = Counter(
+    "websocket_evicted_clients_total",
+    "Number of slow clients disconnected with code 1013",
+    ["instance_id", "reason"]  # reason: queue_full or send_timeout
+)
+websocket_lagging_clients = Gauge(
+    "websocket_lagging_clients",
+    "Number of connections whose send queue is more than half full",
+    ["instance_id"],
+    multiprocess_mode="livesum"
+)
+broadcast_latency = Histogram(
+    "broadcast_latency_seconds",
+    "Time from this instance receiving a broadcast message (from a client, a sibling worker or Redis) "
+    "to queuing it for every local recipient (stage=broadcast) and to writing it to each recipient (stage=send)",
+    ["instance_id", "stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+)
+
+# Children for this instance's labels, resolved once instead of on every message
+connections_gauge = websocket_connections.labels(instance_id=settings.INSTANCE_ID)
+outbound_messages = websocket_messages.labels(instance_id=settings.INSTANCE_ID, direction="outbound")
+queue_depth_gauge = websocket_send_queue_depth.labels(instance_id=settings.INSTANCE_ID)
+lagging_gauge = websocket_lagging_clients.labels(instance_id=settings.INSTANCE_ID)
+broadcast_stage_latency = broadcast_latency.labels(instance_id=settings.INSTANCE_ID, stage="broadcast")
+send_stage_latency = broadcast_latency.labels(instance_id=settings.INSTANCE_ID, stage="send")
+
+
+class Connection:
+    """
+    One local WebSocket connection.
+    Slotted because a node holds tens of thousands of these: no per-instance
+    dict, and attribute access is cheaper than the string-keyed lookups of
+    the plain dict it replaces.
+    """
+    __slots__ = (
+        "websocket", "client_id", "client_ip", "user_id",
+        # Outbound messages, the encoded size of what they hold, and the writer with the
+        # future it waits on while the queue is empty (cheaper than an asyncio.Event per socket)
+        "queue", "buffered_bytes", "lagging", "writer", "wakeup",
+        # Monotonic time of the last message received from the client, for the heartbeat
+        "last_seen",
+        "rooms",
+        # Whether the client negotiated the binary msgpack subprotocol
+        "binary",
+        # Identifies this connection's entry in the cluster-wide registry
+        "registry_token",
+        # Set once disconnected; fan-out snapshots taken earlier may still hold the record
+        "closed"
+    )
+
+    def __init__(self, websocket: WebSocket, client_id: str, client_ip: str, user_id: str, binary: bool = False):
+        self.websocket = websocket
+        self.client_id = client_id
+        self.client_ip = client_ip
+        self.user_id = user_id
+        self.queue: deque = deque()
+        self.buffered_bytes = 0
+        self.lagging = False
+        self.writer: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Future] = None
+        self.last_seen = time.monotonic()
+        self.rooms: Set[str] = set()
+        self.binary = binary
+        self.registry_token = uuid.uuid4().hex
+        self.closed = False
+
 
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: Dict[str, dict] = {}
+        self.active_connections: Dict[str, Connection] = {}
         self.connection_count = 0
+        # Secondary indexes: room / user_id / client IP -> local connections
+        self.rooms: Dict[str, Set[Connection]] = {}
+        self.by_user: Dict[str, Set[Connection]] = {}
+        self.by_ip: Dict[str, Set[Connection]] = {}
+        self.room_listeners: List[Callable[[], None]] = []
+        # Copy-on-write fan-out lists: room (None for everyone) -> immutable tuple of connections.
+        # Membership changes only drop the affected snapshot; the next broadcast rebuilds it.
+        self.snapshots: Dict[Optional[str], Tuple[Connection, ...]] = {}
         
-    async def connect(self, websocket: WebSocket, client_id: str, client_ip: str = None):
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, client_id: str, client_ip: str = None, subprotocol: str = None):
+        await websocket.accept(subprotocol=subprotocol)
+        
+        if client_id in self.active_connections:
+            # The same client reconnected here before its old socket went away; replace it
+            old_websocket = self.active_connections[client_id].websocket
+            self.disconnect(client_id)
+            asyncio.create_task(self._close(old_websocket, 1000))
         
         # Store connection information including IP address
-        connection_info = {
-            "websocket": websocket,
-            "client_id": client_id,
-            "client_ip": client_ip,
-            "user_id": redis_service.get_user_id(client_id, client_ip or "unknown")
-        }
+        connection = Connection(
+            websocket,
+            client_id,
+            client_ip,
+            redis_service.get_user_id(client_id, client_ip or "unknown"),
+            binary=subprotocol == MSGPACK_SUBPROTOCOL
+        )
         
-        self.active_connections[client_id] = connection_info
+        # Each connection gets its own writer so a slow client only delays itself
+        connection.writer = asyncio.create_task(self._writer(connection))
+        
+        self.active_connections[client_id] = connection
+        self.snapshots.pop(None, None)
+        self.by_user.setdefault(connection.user_id, set()).add(connection)
+        self.by_ip.setdefault(client_ip or "unknown", set()).add(connection)
+        self.join_room(client_id, settings.DEFAULT_ROOM)
         self.connection_count += 1
-        websocket_connections.labels(instance_id=settings.INSTANCE_ID).set(self.connection_count)
+        connections_gauge.set(self.connection_count)
+        
+        # Let other nodes route direct messages for this client here
+        await redis_service.register_connection(client_id, connection.registry_token)
         
         # Store connection in Redis
         await redis_service.store_user_connection(
-            connection_info["user_id"], 
+            connection.user_id, 
             client_id, 
             client_ip or "unknown"
         )
         
         logger.info(f"Client {client_id} connected from {client_ip}. Total connections: {self.connection_count}")
 
-    def disconnect(self, client_id: str):
-        if client_id in self.active_connections:
+    def disconnect(self, client_id: str, websocket: Optional[WebSocket] = None):
+        """Remove a client's connection; if websocket is given, only when the entry still belongs to it"""
+        connection = self.active_connections.get(client_id)
+        if connection and (websocket is None or connection.websocket is websocket):
+            for room in list(connection.rooms):
+                self.leave_room(client_id, room)
             del self.active_connections[client_id]
+            connection.closed = True
+            self.snapshots.pop(None, None)
+            self._unindex(self.by_user, connection.user_id, connection)
+            self._unindex(self.by_ip, connection.client_ip or "unknown", connection)
+            connection.writer.cancel()
+            queue_depth_gauge.dec(len(connection.queue))
+            if connection.lagging:
+                lagging_gauge.dec()
             self.connection_count -= 1
-            websocket_connections.labels(instance_id=settings.INSTANCE_ID).set(self.connection_count)
+            connections_gauge.set(self.connection_count)
+            asyncio.create_task(
+                redis_service.unregister_connection(client_id, connection.registry_token)
+            )
             logger.info(f"Client {client_id} disconnected. Total connections: {self.connection_count}")
 
-    async def send_personal_message(self, message: dict, client_id: str):
-        if client_id in self.active_connections:
-            connection_info = self.active_connections[client_id]
-            websocket = connection_info["websocket"]
-            user_id = connection_info["user_id"]
-            
-            websocket_messages.labels(instance_id=settings.INSTANCE_ID, direction="outbound").inc()
-            
-            # Store the message in Redis if it's a chat message
-            if message.get("type") == "chat":
-                await redis_service.store_message(message, user_id)
-                
-            await websocket.send_json(message)
-            logger.debug(f"Message sent to client {client_id}")
-
-    async def broadcast(self, message: dict):
-        websocket_messages.labels(instance_id=settings.INSTANCE_ID, direction="outbound").inc(len(self.active_connections))
-        
-        # Store chat messages in Redis for each connected user
-        if message.get("type") == "chat":
-            sender_id = None
-            # Try to find the sender's user_id if available
-            sender_client_id = message.get("client_id")
-            if sender_client_id and sender_client_id in self.active_connections:
-                sender_id = self.active_connections[sender_client_id]["user_id"]
+    def _unindex(self, index: Dict[str, Set[Connection]], key: str, connection: Connection):
+        members = index.get(key)
+        if members is not None:
+            members.discard(connection)
+            if not members:
+                del index[key]
+
+    def connections_for_user(self, user_id: str) -> Set[Connection]:
+        """All local connections of a user"""
+        return self.by_user.get(user_id, set())
+
+    def connections_for_ip(self, client_ip: str) -> Set[Connection]:
+        """All local connections from one client IP"""
+        return self.by_ip.get(client_ip, set())
+
+    def touch(self, client_id: str):
+        """Record that the client just sent something, so the heartbeat knows it is alive"""
+        connection = self.active_connections.get(client_id)
+        if connection:
+            connection.last_seen = time.monotonic()
+
+    def send_ping(self, client_id: str):
+        """Queue an application-level ping; the client answers with a pong"""
+        connection = self.active_connections.get(client_id)
+        if connection:
+            self._enqueue(connection, MessageEnvelope({"type": "ping", "ts": time.time()}))
+
+    def reap(self, client_id: str):
+        """Drop a connection the heartbeat gave up on and close its socket (1001, going away)"""
+        connection = self.active_connections.get(client_id)
+        if connection:
+            self.disconnect(client_id, connection.websocket)
+            asyncio.create_task(self._close(connection.websocket, 1001))
+
+    def add_room_listener(self, listener: Callable[[], None]):
+        """Register a callback invoked when the set of locally joined rooms changes"""
+        self.room_listeners.append(listener)
+
+    def local_rooms(self) -> Set[str]:
+        """Rooms that at least one local connection has joined"""
+        return set(self.rooms)
+
+    def join_room(self, client_id: str, room: str) -> bool:
+        connection = self.active_connections.get(client_id)
+        if not connection or room in connection.rooms:
+            return False
+        
+        connection.rooms.add(room)
+        members = self.rooms.setdefault(room, set())
+        members.add(connection)
+        self.snapshots.pop(room, None)
+        if len(members) == 1:
+            self._notify_room_listeners()
+        logger.debug(f"Client {client_id} joined room {room}")
+        return True
+
+    def leave_room(self, client_id: str, room: str) -> bool:
+        connection = self.active_connections.get(client_id)
+        if not connection or room not in connection.rooms:
+            return False
+        
+        connection.rooms.discard(room)
+        members = self.rooms.get(room, set())
+        members.discard(connection)
+        self.snapshots.pop(room, None)
+        if not members:
+            self.rooms.pop(room, None)
+            self._notify_room_listeners()
+        logger.debug(f"Client {client_id} left room {room}")
+        return True
+
+    def _notify_room_listeners(self):
+        for listener in self.room_listeners:
+            try:
+                listener()
+            except Exception as e:
+                logger.error(f"Room listener failed: {e}")
+
+    def is_local(self, client_id: str) -> bool:
+        return client_id in self.active_connections
+
+    async def send_personal_message(self, message, client_id: str):
+        """Send a message to a client connected to this node; see MessageBus.send_direct for any node"""
+        connection = self.active_connections.get(client_id)
+        if connection:
+            outbound_messages.inc()
+            self._enqueue(connection, MessageEnvelope.wrap(message))
+            logger.debug(f"Message queued for client {client_id}")
+
+    def persist_message(self, message, client_id: str):
+        """
+        Queue a chat message that originated on this instance for storage.
+        Instances that only relay the message (via Redis) must not call this,
+        so each message is written to Redis once regardless of instance count.
+        """
+        envelope = MessageEnvelope.wrap(message)
+        connection = self.active_connections.get(client_id)
+        sender_id = connection.user_id if connection else None
+        redis_service.persist_message(envelope, sender_id)
+
+    async def broadcast(self, message):
+        """Send a message to the members of its room, or to every connection if it has no room"""
+        # Encode once; every recipient gets the same pre-built frame
+        envelope = MessageEnvelope.wrap(message)
+        room = envelope.data.get("room")
+        
+        if room == settings.DEFAULT_ROOM and envelope.type == "chat":
+            history_cache.add(envelope.data)
+        
+        # An immutable snapshot: connects, disconnects and evictions during the
+        # fan-out change the live sets, never the list we are iterating
+        recipients = self.snapshot(room)
+        outbound_messages.inc(len(recipients))
+        
+        # Only enqueue here; the per-connection writers do the actual sends
+        for connection in recipients:
+            try:
+                self._enqueue(connection, envelope)
+            except Exception as e:
+                # One bad recipient must not cost the rest of the room the message
+                logger.error(f"Failed to queue message for client {connection.client_id}: {e}")
+        
+        if envelope.received_at is not None:
+            broadcast_stage_latency.observe(time.monotonic() - envelope.received_at)
+        logger.debug(f"Broadcast message queued for {len(recipients)} clients")
+
+    def snapshot(self, room: Optional[str] = None) -> Tuple[Connection, ...]:
+        """The current members of a room (everyone if room is None) as an immutable tuple"""
+        recipients = self.snapshots.get(room)
+        if recipients is None:
+            members = self.rooms.get(room) if room else self.active_connections.values()
+            if not members:
+                # Don't cache rooms nobody here is in
+                return ()
+            recipients = self.snapshots[room] = tuple(members)
+        return recipients
+
+    def _is_over_limit(self, connection: Connection, size: int) -> bool:
+        return (
+            len(connection.queue) >= settings.SEND_QUEUE_SIZE
+            or connection.buffered_bytes + size > settings.SEND_QUEUE_MAX_BYTES
+        )
+
+    def _enqueue(self, connection: Connection, envelope: MessageEnvelope):
+        """Put a message on a connection's send queue, applying the overflow policy if it is full"""
+        if connection.closed:
+            return
+        queue = connection.queue
+        size = envelope.size(connection.binary)
+        
+        if self._is_over_limit(connection, size):
+            policy = settings.SEND_QUEUE_POLICY
+            websocket_send_queue_drops.labels(instance_id=settings.INSTANCE_ID, policy=policy).inc()
             
-            # Store the message once in the global message history
-            await redis_service.store_message(message, "global")
+            if policy == "drop_newest":
+                logger.debug(f"Send queue full for client {connection.client_id}, dropping new message")
+                return
+            if policy == "disconnect":
+                self._evict(connection, "queue_full")
+                return
+            if policy == "coalesce":
+                # Too far behind for the backlog to be worth sending; replace it with one
+                # notice so the client reloads history once it catches up
+                skipped = len(queue)
+                self._pop_all(connection)
+                self._append(connection, MessageEnvelope({
+                    "type": "resync",
+                    "skipped": skipped,
+                    "instance_id": settings.INSTANCE_ID
+                }))
+                logger.debug(f"Send queue full for client {connection.client_id}, coalesced {skipped} messages")
             
-            # If this is from a user, store in their personal history too
-            if sender_id:
-                await redis_service.store_message(message, sender_id)
+            # drop_oldest (and whatever coalesce left): discard the stalest messages until it fits
+            while queue and self._is_over_limit(connection, size):
+                self._pop(connection)
         
-        for client_id, connection_info in self.active_connections.items():
-            websocket = connection_info["websocket"]
-            await websocket.send_json(message)
+        self._append(connection, envelope)
+
+    def _append(self, connection: Connection, envelope: MessageEnvelope):
+        connection.queue.append(envelope)
+        connection.buffered_bytes += envelope.size(connection.binary)
+        if connection.wakeup is not None and not connection.wakeup.done():
+            connection.wakeup.set_result(None)
+        queue_depth_gauge.inc()
         
-        logger.debug(f"Broadcast message sent to {len(self.active_connections)} clients")
+        if not connection.lagging and len(connection.queue) * 2 >= settings.SEND_QUEUE_SIZE:
+            connection.lagging = True
+            lagging_gauge.inc()
 
-    async def get_user_history(self, client_id: str, limit: int = 50) -> list:
-        """Fetch message history for a specific user"""
-        if client_id in self.active_connections:
-            user_id = self.active_connections[client_id]["user_id"]
-            return await redis_service.get_user_messages(user_id, limit)
-        return []
+    def _pop(self, connection: Connection) -> MessageEnvelope:
+        envelope = connection.queue.popleft()
+        connection.buffered_bytes -= envelope.size(connection.binary)
+        queue_depth_gauge.dec()
+        
+        if connection.lagging and not connection.queue:
+            connection.lagging = False
+            lagging_gauge.dec()
+        return envelope
+
+    def _pop_all(self, connection: Connection):
+        while connection.queue:
+            self._pop(connection)
+
+    def _evict(self, connection: Connection, reason: str):
+        """Disconnect a client that can't keep up, with 1013 (try again later) so it reconnects"""
+        logger.warning(f"Evicting slow client {connection.client_id} ({reason})")
+        websocket_evicted_clients.labels(instance_id=settings.INSTANCE_ID, reason=reason).inc()
+        self.disconnect(connection.client_id, connection.websocket)
+        asyncio.create_task(self._close(connection.websocket, 1013))
+
+    async def _writer(self, connection: Connection):
+        """Drain a connection's send queue until it is cancelled, the socket fails or a write misses its deadline"""
+        websocket = connection.websocket
+        queue = connection.queue
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                if not queue:
+                    connection.wakeup = loop.create_future()
+                    await connection.wakeup
+                    connection.wakeup = None
+                    continue
+                
+                envelope = self._pop(connection)
+                # A client that stops reading fills its TCP window and the send blocks; don't wait forever
+                if connection.binary:
+                    send = websocket.send_bytes(envelope.packed)
+                else:
+                    send = websocket.send_text(envelope.text)
+                await asyncio.wait_for(send, settings.SEND_TIMEOUT)
+                if envelope.received_at is not None:
+                    send_stage_latency.observe(time.monotonic() - envelope.received_at)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self._evict(connection, "send_timeout")
+        except Exception as e:
+            logger.warning(f"Failed to send to client {connection.client_id}: {e}")
+            # Only drop the entry if it still belongs to this socket (the client may have reconnected)
+            self.disconnect(connection.client_id, websocket)
+
+    async def _close(self, websocket: WebSocket, code: int):
+        try:
+            await websocket.close(code=code)
+        except Exception as e:
+            logger.debug(f"Error closing websocket: {e}")
+
+    async def get_user_history(self, client_id: str, limit: int = 50, cursor: Optional[str] = None) -> Tuple[list, Optional[str]]:
+        """Fetch a page of message history for a specific user, and the cursor of the next page"""
+        connection = self.active_connections.get(client_id)
+        if connection:
+            return await redis_service.get_history_page(redis_service.user_key(connection.user_id), limit, cursor)
+        return [], None
 
-    async def get_chat_history(self, limit: int = 50) -> list:
-        """Fetch global chat history"""
-        return await redis_service.get_recent_messages(limit)
+    async def get_chat_history(
+        self,
+        limit: int = 50,
+        room: str = settings.DEFAULT_ROOM,
+        cursor: Optional[str] = None,
+        cached: bool = False
+    ) -> Tuple[list, Optional[str]]:
+        """
+        Fetch a page of chat history for a room (the global room by default), and the cursor
+        of the next page. With cached, the first page of the global room comes from the local
+        cache and has no next cursor: the cache is in arrival order, which needn't match the
+        (client-supplied) timestamps Redis pages by, so a cursor from it could skip or repeat messages.
+        """
+        if cached and room == settings.DEFAULT_ROOM and cursor is None:
+            return await history_cache.get_recent(limit), None
+        return await redis_service.get_history_page(redis_service.room_key(room), limit, cursor)
 
     def get_connection_stats(self):
         return {
             "instance_id": settings.INSTANCE_ID,
             "active_connections": self.connection_count,
+            "rooms": len(self.rooms),
+            "users": len(self.by_user),
+            "client_ips": len(self.by_ip),
+            "queued_messages": sum(len(c.queue) for c in self.active_connections.values()),
+            "lagging_clients": sum(1 for c in self.active_connections.values() if c.lagging),
+            "send_queue_policy": settings.SEND_QUEUE_POLICY
         }
 
 # Create a global connection manager instance
@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import os
+import socket
+import time
+from typing import Any, Dict, List, Optional
+from config import settings
+from envelope import MessageEnvelope, dumps, loads
+from websocket_manager import manager
+
+logger = logging.getLogger(__name__)
+
+# Datagram kinds
+MESSAGE_FRAME = b"M"
+DIRECT_FRAME = b"D"
+STATS_FRAME = b"S"
+
+
+def worker_socket_path(index: int) -> str:
+    return os.path.join(settings.WORKER_SOCKET_DIR, f"{index}.sock")
+
+
+def worker_id(index: int) -> str:
+    """WORKER_ID of the worker with this index, as computed in config"""
+    return f"{settings.INSTANCE_ID}-w{index}"
+
+
+class WorkerBusProtocol(asyncio.DatagramProtocol):
+    def __init__(self, bus: "WorkerBus"):
+        self.bus = bus
+
+    def datagram_received(self, data: bytes, addr):
+        self.bus.handle_datagram(data)
+
+    def error_received(self, exc: Exception):
+        logger.debug(f"Worker bus error: {exc}")
+
+
+class WorkerBus:
+    """
+    Local fan-out between the worker processes of one instance.
+    Each worker binds a Unix datagram socket; a message created on one worker
+    is sent straight to its siblings instead of making a round trip through
+    Redis. Workers also exchange their stats so /instance can report totals
+    for the whole instance. Does nothing when WORKERS is 1.
+
+    Frames are sent from a plain non-blocking socket rather than the asyncio
+    transport, which only passes send errors to error_received: a sibling
+    that is restarting or too far behind, or a frame over
+    WORKER_BUS_MAX_FRAME, is reported to the caller, which falls back to Redis.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.sender: Optional[socket.socket] = None
+        self.stats_task = None
+        # worker_id -> latest stats reported by that sibling
+        self.sibling_stats: Dict[str, Dict[str, Any]] = {}
+        self.stats_provider = None
+
+    @property
+    def enabled(self) -> bool:
+        return settings.WORKERS > 1
+
+    async def start(self, stats_provider):
+        """Bind this worker's socket and start reporting stats from stats_provider() to siblings"""
+        if not self.enabled:
+            return
+
+        path = worker_socket_path(settings.WORKER_INDEX)
+        os.makedirs(settings.WORKER_SOCKET_DIR, exist_ok=True)
+        if os.path.exists(path):
+            os.unlink(path)
+
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(
+            lambda: WorkerBusProtocol(self),
+            local_addr=path,
+            family=socket.AF_UNIX
+        )
+        self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sender.setblocking(False)
+        self.stats_provider = stats_provider
+        self.stats_task = asyncio.create_task(self.report_stats())
+        logger.info(f"Worker bus listening on {path} ({settings.WORKER_ID})")
+
+    async def stop(self):
+        if self.stats_task:
+            self.stats_task.cancel()
+        if self.sender:
+            self.sender.close()
+            self.sender = None
+        if self.transport:
+            self.transport.close()
+            path = worker_socket_path(settings.WORKER_INDEX)
+            if os.path.exists(path):
+                os.unlink(path)
+
+    def _send_to(self, index: int, frame: bytes) -> bool:
+        """Send a frame to one sibling; False if it is too large or didn't go out"""
+        if len(frame) > settings.WORKER_BUS_MAX_FRAME:
+            return False
+        try:
+            self.sender.sendto(frame, worker_socket_path(index))
+            return True
+        except OSError as e:
+            # The sibling may be restarting (ENOENT, ECONNREFUSED) or not keeping up (EAGAIN)
+            logger.debug(f"Failed to send to worker {index}: {e}")
+            return False
+
+    def _send_to_siblings(self, frame: bytes) -> List[str]:
+        """Send a frame to every sibling; returns the WORKER_IDs of those it didn't reach"""
+        return [
+            worker_id(index)
+            for index in range(settings.WORKERS)
+            if index != settings.WORKER_INDEX and not self._send_to(index, frame)
+        ]
+
+    def forward(self, envelope: MessageEnvelope) -> List[str]:
+        """
+        Hand a locally created message to the sibling workers for their clients.
+        Returns the WORKER_IDs of the siblings it couldn't reach, for the caller to reach through Redis.
+        """
+        if self.sender is None:
+            return []
+        return self._send_to_siblings(MESSAGE_FRAME + envelope.text.encode("utf-8"))
+
+    def send_direct(self, node_id: str, frame: str) -> bool:
+        """Send a direct-message frame to node_id if it is a sibling worker; False otherwise"""
+        if self.sender is None:
+            return False
+        for index in range(settings.WORKERS):
+            if index != settings.WORKER_INDEX and worker_id(index) == node_id:
+                return self._send_to(index, DIRECT_FRAME + frame.encode("utf-8"))
+        return False
+
+    def handle_datagram(self, data: bytes):
+        kind, payload = data[:1], data[1:]
+        try:
+            if kind == MESSAGE_FRAME:
+                envelope = MessageEnvelope.from_text(payload.decode("utf-8"), time.monotonic())
+                asyncio.create_task(manager.broadcast(envelope))
+            elif kind == DIRECT_FRAME:
+                data = loads(payload)
+                asyncio.create_task(manager.send_personal_message(data["message"], data["client_id"]))
+            elif kind == STATS_FRAME:
+                stats = loads(payload)
+                stats["received_at"] = time.monotonic()
+                self.sibling_stats[stats["worker_id"]] = stats
+        except Exception as e:
+            logger.error(f"Failed to handle worker datagram: {e}")
+
+    async def report_stats(self):
+        while True:
+            try:
+                self._send_to_siblings(STATS_FRAME + dumps(self.stats_provider()).encode("utf-8"))
+            except Exception as e:
+                logger.error(f"Failed to report worker stats: {e}")
+            await asyncio.sleep(settings.WORKER_STATS_INTERVAL)
+
+    def live_sibling_stats(self) -> List[Dict[str, Any]]:
+        """Stats of siblings that reported recently"""
+        cutoff = time.monotonic() - 3 * settings.WORKER_STATS_INTERVAL
+        return [
+            {k: v for k, v in stats.items() if k != "received_at"}
+            for stats in self.sibling_stats.values()
+            if stats["received_at"] >= cutoff
+        ]
+
+
+# Create a global worker bus instance
+worker_bus = WorkerBus()
@@ -0,0 +1,120 @@
+"""
+Process launcher for the application.
+
+With WORKERS=1 this simply runs uvicorn. With more, it starts one uvicorn
+process per worker, each with its own listening socket bound to the same
+port with SO_REUSEPORT so the kernel spreads new connections across them.
+All workers share the instance's INSTANCE_ID and talk to each other over
+the worker bus (see worker_bus.py). Workers that exit unexpectedly are
+restarted.
+
+Workers run prometheus_client in multiprocess mode: each writes its metrics
+to files in PROMETHEUS_MULTIPROC_DIR and /metrics on any worker reports the
+combined values, so scrapes through the shared port don't jump between
+processes. Counters and histograms are summed; each gauge declares how its
+workers' values combine.
+
+This module must not import the application: workers are started with the
+"spawn" method and import main:app themselves.
+"""
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+import shutil
+import uvicorn
+from prometheus_client import multiprocess
+from config import settings
+from ws_protocol import ChatWebSocketProtocol
+
+logger = logging.getLogger(__name__)
+
+SERVER_OPTIONS = {
+    # The app's heartbeat (heartbeat.py) replaces uvicorn's per-connection keepalive task
+    "ws_ping_interval": None,
+    # Threshold-based permessage-deflate (see ws_protocol.py)
+    "ws": ChatWebSocketProtocol
+}
+
+# Minimum time between restarts of the same crashed worker (seconds)
+RESTART_DELAY = 1.0
+
+
+def bind_socket() -> socket.socket:
+    """Listening socket for one worker; every worker binds its own with SO_REUSEPORT"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((settings.HOST, settings.PORT))
+    sock.set_inheritable(True)
+    return sock
+
+
+def serve_worker():
+    """Entry point of a worker process; settings.WORKER_INDEX was set through the environment"""
+    sock = bind_socket()
+    config = uvicorn.Config("main:app", host=settings.HOST, port=settings.PORT, **SERVER_OPTIONS)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+def start_worker(context, index: int):
+    # Spawned processes inherit the environment at start time, which is how they learn their index
+    os.environ["WORKER_INDEX"] = str(index)
+    process = context.Process(target=serve_worker, name=f"worker-{index}")
+    process.start()
+    logger.info(f"Started worker {index} (pid {process.pid})")
+    return process
+
+
+def run_workers():
+    # Every worker must report the same instance id, so fix it before spawning
+    os.environ["INSTANCE_ID"] = settings.INSTANCE_ID
+    os.environ["WORKERS"] = str(settings.WORKERS)
+    os.makedirs(settings.WORKER_SOCKET_DIR, exist_ok=True)
+    # Must be set before the workers import prometheus_client; start from empty files each run
+    metrics_dir = os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(settings.WORKER_SOCKET_DIR, "metrics"))
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+    context = multiprocessing.get_context("spawn")
+    workers = {index: start_worker(context, index) for index in range(settings.WORKERS)}
+    stopping = False
+
+    def handle_signal(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for process in workers.values():
+            if process.is_alive():
+                process.terminate()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    while not stopping:
+        time.sleep(RESTART_DELAY)
+        for index, process in list(workers.items()):
+            if not process.is_alive() and not stopping:
+                logger.warning(f"Worker {index} exited with code {process.exitcode}, restarting")
+                # Drop its live gauges; its counters keep counting towards the totals
+                multiprocess.mark_process_dead(process.pid)
+                workers[index] = start_worker(context, index)
+
+    for process in workers.values():
+        process.join()
+    logger.info("All workers stopped")
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    logger.info(f"Instance ID: {settings.INSTANCE_ID}, workers: {settings.WORKERS}")
+    if settings.WORKERS > 1:
+        run_workers()
+    else:
+        # Auto-reload only makes sense for a single development process
+        uvicorn.run("main:app", host=settings.HOST, port=settings.PORT, reload=settings.DEBUG, **SERVER_OPTIONS)
+
+
+if __name__ == "__main__":
+    main()
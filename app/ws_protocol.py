@@ -0,0 +1,71 @@
+"""
+WebSocket protocol used by the uvicorn servers (see workers.py).
+
+uvicorn's websockets implementation always compresses every frame once
+permessage-deflate is negotiated. Compressing a 100-byte chat message
+costs CPU and saves next to nothing, so this protocol negotiates the
+extension as usual but leaves frames under WS_COMPRESSION_THRESHOLD
+bytes uncompressed, which RFC 7692 allows per message. Connection
+history and other large payloads are still compressed.
+
+Like workers.py, this module must not import the application.
+"""
+from typing import List, Sequence, Tuple
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets import frames
+from websockets.extensions.base import Extension
+from websockets.extensions.permessage_deflate import PerMessageDeflate, ServerPerMessageDeflateFactory
+from websockets.typing import ExtensionParameter
+from config import settings
+
+
+class ThresholdPerMessageDeflate(PerMessageDeflate):
+    """permessage-deflate that sends small, unfragmented messages uncompressed"""
+
+    def __init__(self, *args, threshold: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.threshold = threshold
+
+    def encode(self, frame: frames.Frame) -> frames.Frame:
+        # Only whole messages may be skipped; continuation frames belong to a compressed message
+        if (
+            frame.opcode in (frames.OP_TEXT, frames.OP_BINARY)
+            and frame.fin
+            and len(frame.data) < self.threshold
+        ):
+            return frame
+        return super().encode(frame)
+
+
+class ThresholdDeflateFactory(ServerPerMessageDeflateFactory):
+    """Negotiates permessage-deflate like the default factory, with a compression threshold"""
+
+    def __init__(self, threshold: int, **kwargs):
+        super().__init__(**kwargs)
+        self.threshold = threshold
+
+    def process_request_params(
+        self,
+        params: Sequence[ExtensionParameter],
+        accepted_extensions: Sequence[Extension],
+    ) -> Tuple[List[ExtensionParameter], PerMessageDeflate]:
+        response_params, extension = super().process_request_params(params, accepted_extensions)
+        return response_params, ThresholdPerMessageDeflate(
+            extension.remote_no_context_takeover,
+            extension.local_no_context_takeover,
+            extension.remote_max_window_bits,
+            extension.local_max_window_bits,
+            extension.compress_settings,
+            threshold=self.threshold
+        )
+
+
+class ChatWebSocketProtocol(WebSocketProtocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.available_extensions = []
+        if settings.WS_COMPRESSION:
+            self.available_extensions.append(
+                # memLevel 5 halves zlib's per-connection memory at a small cost in ratio
+                ThresholdDeflateFactory(settings.WS_COMPRESSION_THRESHOLD, compress_settings={"memLevel": 5})
+            )
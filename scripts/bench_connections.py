@@ -0,0 +1,108 @@
+"""
+Memory and fan-out benchmark for the ConnectionManager.
+
+Opens N connections through ConnectionManager.connect with fake sockets and the
+Redis calls stubbed out, then reports with tracemalloc the bytes one Connection
+record takes, the bytes per connection including its writer task and indexes,
+and how long one broadcast to every connection takes to enqueue.
+
+Usage: python scripts/bench_connections.py [--connections 10000] [--broadcasts 20]
+"""
+import argparse
+import asyncio
+import gc
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app")
+sys.path.insert(0, APP_DIR)
+
+from redis_service import redis_service  # noqa: E402
+from websocket_manager import Connection, manager  # noqa: E402
+
+
+class FakeWebSocket:
+    """Accepts the connection and discards whatever is sent to it"""
+    __slots__ = ()
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def send_text(self, text):
+        pass
+
+    async def send_bytes(self, data):
+        pass
+
+
+async def noop(*args, **kwargs):
+    pass
+
+
+def measure(build):
+    """Bytes still allocated after calling build(), as traced by tracemalloc"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return after - before, kept
+
+
+async def run(connections: int, broadcasts: int):
+    # Only the manager's own bookkeeping is measured, not Redis round trips
+    redis_service.register_connection = noop
+    redis_service.unregister_connection = noop
+    redis_service.store_user_connection = noop
+
+    sockets = [FakeWebSocket() for _ in range(connections)]
+    client_ids = [f"client-{i:06d}" for i in range(connections)]
+    client_ips = [f"10.0.{i // 256 % 256}.{i % 256}" for i in range(connections)]
+
+    record_bytes, _ = measure(lambda: [
+        Connection(websocket, client_id, client_ip, redis_service.get_user_id(client_id, client_ip))
+        for websocket, client_id, client_ip in zip(sockets, client_ids, client_ips)
+    ])
+    print(f"Connection record: {record_bytes / connections:.0f} bytes")
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for websocket, client_id, client_ip in zip(sockets, client_ids, client_ips):
+        await manager.connect(websocket, client_id, client_ip)
+    # Let the writer tasks start and park on their empty queues
+    await asyncio.sleep(0)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print(f"Per connection, with writer task and indexes: {(after - before) / connections:.0f} bytes")
+
+    elapsed = 0.0
+    for i in range(broadcasts):
+        start = time.perf_counter()
+        await manager.broadcast({"type": "chat", "room": "global", "content": f"message {i}"})
+        elapsed += time.perf_counter() - start
+        # Let the writers drain so the queues don't fill up between rounds
+        await asyncio.sleep(0)
+    print(f"Broadcast enqueue to {connections} connections: {elapsed / broadcasts * 1000:.1f} ms")
+
+    for client_id in client_ids:
+        manager.disconnect(client_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=10000)
+    parser.add_argument("--broadcasts", type=int, default=20)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+    asyncio.run(run(args.connections, args.broadcasts))
+
+
+if __name__ == "__main__":
+    main()